@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Routing table of alias pages (AbstractAliasPage), used by AliasMiddleware to redirect
+before Wagtail routes the request through the page tree.
+
+Table maps path of every live alias page to the url of the page it finally points to
+(chains of live aliases are followed, so client gets one redirect). Aliases with view restrictions
+(PageViewRestriction on them or their ancestors) are left to Wagtail, which checks the restriction,
+chains stop at them. Table is built for all sites at once,
+kept in process memory and rebuilt when any page changes (checked at most once per
+WAGBOOT_ALIASES_CHECK_INTERVAL seconds, default: 1).
+"""
+from __future__ import absolute_import, unicode_literals
+
+from wagtail.wagtailcore.models import Page, PageViewRestriction, Site, get_page_models
+
+from wagboot.cache import ProcessCache, GENERATION_PAGES
+from wagboot.routing import get_page_url, iter_page_paths
+
+_alias_maps = ProcessCache(GENERATION_PAGES, 'WAGBOOT_ALIASES_CHECK_INTERVAL')
+
+
+def _build_alias_maps():
+    """
+    :return: {site_id: {path: url}}
+    """
+    from wagboot.models import AbstractAliasPage
+
+    restricted_paths = tuple(PageViewRestriction.objects.values_list('page__path', flat=True))
+
+    # {alias page id: (url_path, target page id)}
+    aliases = {}
+    for model in get_page_models():
+        if issubclass(model, AbstractAliasPage):
+            aliases.update(
+                (page_id, (url_path, target_id))
+                for page_id, path, url_path, target_id in model.objects.filter(live=True).values_list(
+                    'id', 'path', 'url_path', 'alias_for_page_id')
+                if not (restricted_paths and path.startswith(restricted_paths)))
+    if not aliases:
+        return {}
+
+    target_url_paths = dict(Page.objects.filter(id__in=set(target_id for url_path, target_id in aliases.values()))
+                            .values_list('id', 'url_path'))
+    root_paths = Site.get_site_root_paths()
+
+    maps = {}
+    for page_id, (url_path, target_id) in aliases.items():
+        # Follow chain of aliases (stop on cycles)
+        seen = {page_id}
+        while target_id in aliases and target_id not in seen:
+            seen.add(target_id)
+            target_id = aliases[target_id][1]
+
+        target_url_path = aliases[target_id][0] if target_id in aliases else target_url_paths.get(target_id)
+        target_url = get_page_url(target_url_path, root_paths) if target_url_path else None
+        if not target_url:
+            # Page will be served by Wagtail
+            continue
+        for site_id, path in iter_page_paths(url_path, root_paths):
+            maps.setdefault(site_id, {})[path] = target_url
+    return maps
+
+
+def get_alias_target(site, path):
+    """
+    Returns url to redirect to if the path is an alias page on the site, None otherwise.
+    :type site: wagtail.wagtailcore.models.Site
+    :param path: request.path
+    """
+    return _alias_maps.get('maps', _build_alias_maps).get(site.pk, {}).get(path)
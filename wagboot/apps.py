@@ -8,6 +8,8 @@ class WagbootConfig(AppConfig):
     name = 'wagboot'
 
     def ready(self):
+        from wagboot import signals  # noqa: connects cache invalidation handlers
+
         from wagtail.wagtailimages.formats import register_image_format, Format, unregister_image_format
         unregister_image_format('left')
         unregister_image_format('right')
@@ -3,7 +3,9 @@ from __future__ import absolute_import, unicode_literals
 
 from email.utils import formataddr
 
+import hashlib
 import six
+import threading
 import warnings
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Submit
@@ -13,11 +15,12 @@ from django.contrib import messages
 from django.contrib.auth import REDIRECT_FIELD_NAME, login, logout, get_user_model
 from django.contrib.auth.forms import AuthenticationForm, PasswordChangeForm
 from django.contrib.auth.tokens import PasswordResetTokenGenerator
-from django.core.mail import send_mail
+from django.core.mail import EmailMultiAlternatives
 from django.shortcuts import resolve_url
 from django.template.loader import render_to_string
 from django.utils.encoding import force_text, force_bytes, force_str
 from django.utils.http import is_safe_url, urlsafe_base64_decode, urlsafe_base64_encode
+from django.utils import translation
 from django.utils.safestring import mark_safe
 from django.views.generic.edit import FormMixin
 from wagtail.wagtailcore import blocks
@@ -25,8 +28,74 @@ from wagtail.wagtailcore.blocks import DeclarativeSubBlocksMetaclass
 from wagtail.wagtailimages.blocks import ImageChooserBlock
 
 from wagboot import choices
+from wagboot.cache import make_key
 from wagboot.forms import SetPasswordForm, PasswordResetForm
-from wagboot.redirects import mark_request_for_redirect
+from wagboot.mail import send_email
+from wagboot.redirects import extract_redirect_data_from_request, mark_request_for_redirect, \
+    should_stop_on_redirect, RedirectRequested
+
+
+_render_local = threading.local()
+
+# Context variable with prefix assigned to the block before rendering (see wagboot.rendering)
+PREFIX_CONTEXT_VAR = 'wagboot_block_prefix'
+
+# Values of `wagboot_depends_on` in Meta of blocks: what their html depends on (see wagboot.rendering)
+DEPENDS_ON_NOTHING = 'nothing'
+DEPENDS_ON_USER = 'user'
+DEPENDS_ON_REQUEST = 'request'
+
+
+def gen_block_prefix(request):
+    """
+    Returns prefix for the next block on the page, block number is stored on request.
+    """
+    request._wagboot_block_counter = getattr(request, '_wagboot_block_counter', 0) + 1
+    return 'block-{counter}'.format(counter=request._wagboot_block_counter)
+
+
+def get_posted_prefixes(request):
+    """
+    Returns set of form prefixes which have data in POST of the request, computed once per request.
+    Every dash-separated beginning of the key is a prefix ('block-1-email' -> 'block', 'block-1', 'block-1-email').
+    :rtype: frozenset
+    """
+    prefixes = getattr(request, '_wagboot_posted_prefixes', None)
+    if prefixes is None:
+        prefixes = set()
+        for key in request.POST.keys():
+            parts = key.split('-')
+            for i in range(1, len(parts) + 1):
+                prefixes.add('-'.join(parts[:i]))
+        prefixes = request._wagboot_posted_prefixes = frozenset(prefixes)
+    return prefixes
+
+
+class RenderState(object):
+    """
+    Data of one rendering of a block: request, prefix, block_value and anything else
+    subclasses need to keep during the render (set it on block.render_state).
+
+    Block instances are shared by all pages and threads, so this data is kept per thread
+    (and per block, nested renders of the same block get their own state).
+    """
+    request = None
+    prefix = None
+    block_value = None
+
+    def __init__(self):
+        # Values computed by WagbootBlockMixin.memoize()
+        self.memoized = {}
+
+
+def _render_state_property(name):
+    def getter(self):
+        return getattr(self.render_state, name)
+
+    def setter(self, value):
+        setattr(self.render_state, name, value)
+
+    return property(getter, setter, doc="{} of the current render (see RenderState)".format(name))
 
 
 class WagbootBlockMixin(object):
@@ -42,10 +111,41 @@ class WagbootBlockMixin(object):
       - optionally override after_render_cleanup to delete something that was saved on a block during render
         or action processing
 
+    .request, .prefix and .block_value are kept in .render_state, which is local to the thread doing the render,
+    so the same block can be rendered by several threads at once. Other data needed during render
+    should be saved on .render_state as well (not on the block itself).
+    Values which are expensive to compute and are needed several times during render can be
+    memoized with .memoize().
+
     Note: block must have a template for this mixin to work.
 
     """
 
+    request = _render_state_property('request')
+    prefix = _render_state_property('prefix')
+    block_value = _render_state_property('block_value')
+
+    @property
+    def render_state(self):
+        """
+        :rtype: RenderState
+        """
+        states = getattr(_render_local, 'states', {}).get(id(self))
+        if not states:
+            raise AttributeError("{} is not being rendered".format(type(self).__name__))
+        return states[-1]
+
+    def _push_render_state(self):
+        if not hasattr(_render_local, 'states'):
+            _render_local.states = {}
+        _render_local.states.setdefault(id(self), []).append(RenderState())
+
+    def _pop_render_state(self):
+        states = _render_local.states[id(self)]
+        states.pop()
+        if not states:
+            del _render_local.states[id(self)]
+
     def pre_render_action(self):
         """
         Will be called before rendering template.
@@ -58,32 +158,43 @@ class WagbootBlockMixin(object):
         """
         return {}
 
+    def memoize(self, key, func):
+        """
+        Returns func() computed once per render of the block (cached value is dropped by after_render_cleanup).
+        :param key: name of the value, unique within the block
+        :param func: callable without arguments
+        """
+        memoized = self.render_state.memoized
+        if key not in memoized:
+            memoized[key] = func()
+        return memoized[key]
+
     def after_render_cleanup(self):
         """
         Will be called after rendering block if some property should be cleaned up.
         (Block is shared between block instances on the page)
+        render_state is dropped after this call.
         """
-        del self.request
-        del self.prefix
-        del self.block_value
+        self.render_state.memoized.clear()
 
     def extract_request_data_from_context(self, value, context):
         """
-        Used to save some data on the block instance for request processing.
-        All this data must be cleared in after_render_cleanup.
+        Used to save some data on the render_state for request processing.
         """
 
         if context is None or 'request' not in context:
             raise ValueError("This block must have access to request through context: {}".format(context))
 
         self.request = context['request']
-        self.prefix = self._gen_prefix(value)
+        self.prefix = context.get(PREFIX_CONTEXT_VAR) or self._gen_prefix(value)
         self.block_value = value
 
     def get_context(self, value):
         context = super(WagbootBlockMixin, self).get_context(value)
         context.update({
-            'prefix': self.prefix
+            'prefix': self.prefix,
+            # Assigned prefix is only for this block, not for the blocks inside it
+            PREFIX_CONTEXT_VAR: None,
         })
         return context
 
@@ -92,13 +203,14 @@ class WagbootBlockMixin(object):
         Prefix generator is storing block number on request.
         Idea is - if we are generating same page all the blocks will be in the same order.
         """
-        self.request._wagboot_block_counter = getattr(self.request, '_wagboot_block_counter', 0) + 1
-
-        return 'block-{counter}'.format(counter=self.request._wagboot_block_counter)
+        return gen_block_prefix(self.request)
 
     def redirect_page(self, url, permanent=False):
         mark_request_for_redirect(self.request, url, permanent)
 
+    def request_has_redirect(self):
+        return bool(extract_redirect_data_from_request(self.request))
+
     def render(self, value, context=None):
         """
         Return a text rendering of 'value', suitable for display on templates.
@@ -109,9 +221,10 @@ class WagbootBlockMixin(object):
         - pre_render_action():
             - can do some processing of the GET or POST
             - may return dict to add to context before rendering
-            - may redirect page (by calling redirect_page())
+            - may redirect page (by calling redirect_page()), if the page is served with
+              serve_with_redirects() rendering of the page stops here (RedirectRequested is raised)
         - after_render_cleanup:
-            - deletes saved request and other values on the object (actual block instance is reused between requests)
+            - can clean up after rendering, render_state (with request and other values) is dropped after it
 
         :param value: Block value
         :param context: context of the page, must contain request.
@@ -119,19 +232,25 @@ class WagbootBlockMixin(object):
         if not getattr(self.meta, 'template', None):
             raise ValueError("This block must have a template")
 
-        self.extract_request_data_from_context(value, context)
+        self._push_render_state()
+        try:
+            self.extract_request_data_from_context(value, context)
 
-        add_context = self.pre_render_action()
-        if add_context:
-            if isinstance(add_context, dict):
-                context.update(add_context)
-            else:
-                raise ValueError("pre_render_action may only return dict or nothing, got: {}".format(add_context))
+            add_context = self.pre_render_action()
+            if should_stop_on_redirect(self.request) and self.request_has_redirect():
+                raise RedirectRequested()
+            if add_context:
+                if isinstance(add_context, dict):
+                    context.update(add_context)
+                else:
+                    raise ValueError("pre_render_action may only return dict or nothing, got: {}".format(add_context))
 
-        try:
-            return super(WagbootBlockMixin, self).render(value, context=context)
+            try:
+                return super(WagbootBlockMixin, self).render(value, context=context)
+            finally:
+                self.after_render_cleanup()
         finally:
-            self.after_render_cleanup()
+            self._pop_render_state()
 
 
 class FormBlockMixin(WagbootBlockMixin, FormMixin):
@@ -149,9 +268,14 @@ class FormBlockMixin(WagbootBlockMixin, FormMixin):
 
     get_form_helper() creates default FormHelper and adds Submit input with text from get_submit_text() method.
 
+    Html of unbound forms without initial data can be cached when rendered with {% wagboot_crispy form %},
+    set cache_unbound_form = True if it depends only on what is in get_form_render_cache_key()
+    (definition of the form fields, submit text, prefix and language, but not the user or request).
+
     """
     success_message = None
     submit_text = 'Submit'
+    cache_unbound_form = False
 
     def get_success_message(self):
         return self.success_message
@@ -179,7 +303,9 @@ class FormBlockMixin(WagbootBlockMixin, FormMixin):
         If not - this POST request is not for this form.
         :return: bool
         """
-        return any(key.startswith(self.prefix) for key in self.request.POST.keys())
+        if self.request.method.lower() != 'post':
+            return False
+        return self.memoize('data_present', lambda: self.prefix in get_posted_prefixes(self.request))
 
     def get_form_kwargs(self):
         kwargs = super(FormBlockMixin, self).get_form_kwargs()
@@ -208,6 +334,30 @@ class FormBlockMixin(WagbootBlockMixin, FormMixin):
             helper.add_input(Submit('{}-submit_button'.format(self.prefix), submit_text))
         return helper
 
+    def get_form_render_cache_key(self, form):
+        """
+        Returns cache key of rendered html of the form (without CSRF token), None if it should not be cached.
+        """
+        if not self.cache_unbound_form or form.is_bound or form.initial:
+            return None
+        signature = '|'.join([
+            '{}.{}'.format(type(self).__module__, type(self).__name__),
+            self.prefix,
+            '{}.{}'.format(type(form).__module__, type(form).__name__),
+            force_text(self.get_submit_text()),
+            translation.get_language() or '',
+            getattr(getattr(form, 'helper', None), 'template_pack', None) or
+            getattr(settings, 'CRISPY_TEMPLATE_PACK', 'bootstrap'),
+        ] + [self._get_field_signature(name, field) for name, field in form.fields.items()])
+        return make_key('form', hashlib.sha1(force_bytes(signature)).hexdigest())
+
+    @staticmethod
+    def _get_field_signature(name, field):
+        # Html changes with the definition of the field (e.g. after deploy)
+        return '{}:{}.{}:{}:{}:{}:{}'.format(
+            name, type(field).__name__, type(field.widget).__name__, force_text(field.label),
+            force_text(field.help_text), field.required, sorted(field.widget.attrs.items()))
+
     def pre_render_action(self):
         """
         Creates and processes form.
@@ -232,6 +382,9 @@ class FormBlockMixin(WagbootBlockMixin, FormMixin):
             if should_be_none is not None:
                 warnings.warn("form_valid and form_invalid in form blocks should not return anything. "
                               "Block will be re-rendered by render(). Got: {}".format(force_str(should_be_none)))
+        # Used by {% wagboot_crispy %}, form gets bound above only if it is processed
+        form.wagboot_render_cache_key = self.get_form_render_cache_key(form)
+
         context = super(FormBlockMixin, self).pre_render_action()
         context.update({
             'form': form
@@ -264,6 +417,7 @@ class FormWithLegendBlock(_BaseFormWithLegend):
         # help_text = "Shows form with legend on the right and redirects to the success_page"
         # icon = "fa-user-plus"
         template = "wagboot/blocks/form_with_legend.html"
+        wagboot_depends_on = DEPENDS_ON_REQUEST
 
     def get_success_url(self):
         # It is required, so should be present
@@ -275,6 +429,7 @@ class LoginBlock(FormWithLegendBlock):
     form_class = AuthenticationForm
     success_message = "You have signed in"
     submit_text = "Login"
+    cache_unbound_form = True
 
     class Meta:
         label = "Login Form"
@@ -316,6 +471,7 @@ class LogoutBlock(WagbootBlockMixin, blocks.StructBlock):
         help_text = "Logs user out. Redirects to the given page or root of the website"
         icon = "user"
         template = "wagboot/blocks/logout.html"
+        wagboot_depends_on = DEPENDS_ON_REQUEST
 
     def get_success_url(self):
         next_url = '/'
@@ -354,6 +510,7 @@ class NoFieldsBlock(blocks.Block):
         default = Empty()
         form_classname = ''
         form_template = "wagboot/blocks/no_fields_form.html"
+        wagboot_depends_on = DEPENDS_ON_USER
 
     def to_python(self, value):
         return Empty()
@@ -392,6 +549,7 @@ class PasswordResetBlock(FormWithLegendBlock):
                                                       "after it)")
 
     token_generator = PasswordResetTokenGenerator()
+    cache_unbound_form = True
 
     _use_https = True
 
@@ -433,14 +591,12 @@ class PasswordResetBlock(FormWithLegendBlock):
     def get_user_model(self):
         return get_user_model()
 
-    _sent_reset_link = False
-
     def get_context(self, value):
         context = super(PasswordResetBlock, self).get_context(value)
 
         context.update({
             'valid_link': self._is_valid_reset_link(),
-            'sent_reset_link': self._sent_reset_link
+            'sent_reset_link': getattr(self.render_state, 'sent_reset_link', False)
         })
 
         return context
@@ -456,6 +612,12 @@ class PasswordResetBlock(FormWithLegendBlock):
         return initial
 
     def _get_valid_user(self):
+        """
+        Checked once per render: decoding of uid, user query and token check.
+        """
+        return self.memoize('valid_user', self._find_valid_user)
+
+    def _find_valid_user(self):
         uid64, token = self._get_uid64_and_token()
         if uid64 and token:
             UserModel = self.get_user_model()
@@ -492,51 +654,62 @@ class PasswordResetBlock(FormWithLegendBlock):
             return super(PasswordResetBlock, self).form_valid(form)
         else:
             user = form.get_user()
-            self._sent_reset_link = True
+            self.render_state.sent_reset_link = True
             self._send_reset_link(user)
             messages.success(self.request, "Please check your email for instructions on resetting your password")
             # We do not redirect in this case, only show message in template
 
     def _send_reset_link(self, user):
+        message = self.build_reset_message(user, self.block_value, self.request.site, self.request.path_info)
+        send_email(message)
+
+    def build_reset_message(self, user, block_value, site, path):
+        """
+        Creates email with password reset link for the user.
+        Does not use request, so can be used outside of rendering (e.g. in wagboot_send_password_resets command).
+
+        :param block_value: value of this block (subject and text of the email)
+        :param site: site of the page with this block
+        :param path: path of the page with this block
+        :rtype: EmailMultiAlternatives
+        """
         from wagboot.models import WebsiteSettings
         reset_link = "{protocol}://{domain}{url}?reset_token={token}&reset_uid={uid64}"
 
         reset_link = reset_link.format(protocol="https" if self._use_https else "http",
-                                       domain=self.request.site.hostname,
-                                       url=self.request.path_info,
+                                       domain=site.hostname,
+                                       url=path,
                                        uid64=force_str(urlsafe_base64_encode(force_bytes(user.pk))),
                                        token=self.token_generator.make_token(user))
 
-        from_email = WebsiteSettings.get_from_email(self.request.site, True)
+        from_email = WebsiteSettings.get_from_email(site, True)
         if not from_email:
             raise ValueError("Password reset block requires 'from_email' in website settings to be set")
         to_email = formataddr(("{}".format(user), user.email))
-        subject = self.block_value['reset_email_subject'].replace('\n', '')
+        subject = block_value['reset_email_subject'].replace('\n', '')
 
         context = {
             'reset_link': mark_safe(reset_link),
-            'email_text': self.block_value['reset_email_text'],
-            'site': self.request.site,
+            'email_text': block_value['reset_email_text'],
+            'site': site,
             'user': user
         }
 
         html_body = render_to_string(self.template_email_body_html, context=context)
         text_body = render_to_string(self.template_email_body_text, context=context)
 
-        send_mail(subject=subject,
-                  message=text_body,
-                  html_message=html_body,
-                  from_email=from_email,
-                  recipient_list=[to_email])
-
-    def after_render_cleanup(self):
-        super(PasswordResetBlock, self).after_render_cleanup()
-        self._sent_reset_link = False
+        message = EmailMultiAlternatives(subject=subject,
+                                         body=text_body,
+                                         from_email=from_email,
+                                         to=[to_email])
+        message.attach_alternative(html_body, 'text/html')
+        return message
 
 
 class PasswordChangeBlock(FormWithLegendBlock):
     form_class = PasswordChangeForm
     success_message = "Password has been changed"
+    cache_unbound_form = True
 
     submit_text = "Change Password"
 
@@ -544,6 +717,7 @@ class PasswordChangeBlock(FormWithLegendBlock):
         label = "Password change"
         help_text = "Lets user change password by entering old password first"
         # template = "wagboot/blocks/password_change.html"
+        wagboot_depends_on = DEPENDS_ON_USER
 
     def get_form_kwargs(self):
         kwargs = super(PasswordChangeBlock, self).get_form_kwargs()
@@ -569,6 +743,8 @@ class JumbotronBlock(blocks.StructBlock):
         help_text = "Shows full-width block with a given text and background picture"
         icon = "image"
         template = "wagboot/blocks/jumbotron.html"
+        wagboot_depends_on = DEPENDS_ON_NOTHING
+        wagboot_image_specs = ('original',)
 
 
 class FeaturesCarouselBlock(blocks.ListBlock):
@@ -578,6 +754,8 @@ class FeaturesCarouselBlock(blocks.ListBlock):
         help_text = "Shows carousel with 'features' of the product (do not use it)"
         icon = "bin"
         template = "wagboot/blocks/features_carousel.html"
+        wagboot_depends_on = DEPENDS_ON_NOTHING
+        wagboot_image_specs = ('width-100', 'width-60', 'width-40')
 
     def __init__(self, *args, **kwargs):
         super(FeaturesCarouselBlock, self).__init__(blocks.StructBlock([
@@ -597,6 +775,8 @@ class TextSmallImageBlock(blocks.StructBlock):
         help_text = "Shows Text and small image to the right"
         icon = "doc-full"
         template = "wagboot/blocks/text_small_image.html"
+        wagboot_depends_on = DEPENDS_ON_NOTHING
+        wagboot_image_specs = ('width-100',)
 
 
 class SmallImageTextBlock(blocks.StructBlock):
@@ -608,6 +788,8 @@ class SmallImageTextBlock(blocks.StructBlock):
         help_text = "Shows small image and text to the right"
         icon = "image"
         template = "wagboot/blocks/small_image_text.html"
+        wagboot_depends_on = DEPENDS_ON_NOTHING
+        wagboot_image_specs = ('width-100',)
 
 
 class TextImageBlock(blocks.StructBlock):
@@ -619,6 +801,8 @@ class TextImageBlock(blocks.StructBlock):
         help_text = "Shows Text and image to the right"
         icon = "doc-full"
         template = "wagboot/blocks/text_image.html"
+        wagboot_depends_on = DEPENDS_ON_NOTHING
+        wagboot_image_specs = ('width-450', 'width-400', 'width-344')
 
 
 class ImageTextBlock(blocks.StructBlock):
@@ -630,6 +814,8 @@ class ImageTextBlock(blocks.StructBlock):
         help_text = "Shows image and text to the right"
         icon = "image"
         template = "wagboot/blocks/image_text.html"
+        wagboot_depends_on = DEPENDS_ON_NOTHING
+        wagboot_image_specs = ('width-450', 'width-400', 'width-344')
 
 
 class TextBlock(blocks.StructBlock):
@@ -641,3 +827,4 @@ class TextBlock(blocks.StructBlock):
         help_text = "Shows text block"
         icon = "doc-full"
         template = "wagboot/blocks/text.html"
+        wagboot_depends_on = DEPENDS_ON_NOTHING
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Caching helpers used by wagboot.
+
+Cached values are never deleted one by one. Every group of values (menus, settings, ...)
+has a "generation" stored in the cache which is a part of every key in the group.
+Signal handlers bump the generation when something in the group changes, so old keys
+are not used anymore and expire by themselves.
+
+Settings:
+  - WAGBOOT_CACHE: cache alias to use (default: 'default')
+  - WAGBOOT_CACHE_TIMEOUT: timeout of cached values in seconds (default: one day)
+"""
+from __future__ import absolute_import, unicode_literals
+
+import time
+
+import six
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.encoding import force_text
+
+GENERATION_IMAGES = 'images'
+GENERATION_MENUS = 'menus'
+GENERATION_PAGES = 'pages'
+GENERATION_SETTINGS = 'settings'
+
+
+def get_cache():
+    return caches[getattr(settings, 'WAGBOOT_CACHE', 'default')]
+
+
+def get_timeout():
+    return getattr(settings, 'WAGBOOT_CACHE_TIMEOUT', 24 * 60 * 60)
+
+
+def make_key(*parts):
+    return 'wagboot:{}'.format(':'.join(force_text(part) for part in parts))
+
+
+def _new_generation():
+    # Time based, so generation restored after eviction does not match keys created before it
+    return int(time.time() * 1000)
+
+
+def get_generation(name):
+    """
+    Returns current generation of the group of cached values.
+    :type name: basestring
+    """
+    return get_generations(name)[0]
+
+
+def get_generations(*names):
+    """
+    Returns current generations of several groups at once (one cache request when warm).
+    :return: list
+    """
+    keys = [make_key('generation', name) for name in names]
+    cache = get_cache()
+    generations = cache.get_many(keys)
+    for key in keys:
+        if generations.get(key) is None:
+            cache.add(key, _new_generation(), None)
+            generations[key] = cache.get(key)
+    return [generations[key] for key in keys]
+
+
+def bump_generation(name):
+    """
+    Invalidates all cached values of the group.
+    :type name: basestring
+    """
+    for process_cache in _process_caches:
+        if name in process_cache.generations:
+            process_cache.clear()
+
+    key = make_key('generation', name)
+    cache = get_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Generation was never set or was evicted
+        cache.set(key, _new_generation(), None)
+
+
+_process_caches = []
+
+
+class ProcessCache(object):
+    """
+    Values kept in memory of the process (e.g. lookup tables, which are too big to load from cache
+    for every request). Values are dropped when any of their generations changes,
+    generations are checked at most once per check interval (1 second by default).
+    """
+
+    def __init__(self, generation, check_interval_setting=None):
+        """
+        :param generation: name of the generation of the values, or tuple of names
+        :param check_interval_setting: name of the setting with the check interval in seconds
+        """
+        self.generations = (generation,) if isinstance(generation, six.string_types) else tuple(generation)
+        self.check_interval_setting = check_interval_setting
+        self._values = {}
+        self._state = {'generations': None, 'checked_at': 0}
+        _process_caches.append(self)
+
+    def get(self, key, build):
+        """
+        Returns value for the key, calls build() to compute it if it is missing.
+        """
+        now = time.time()
+        check_interval = getattr(settings, self.check_interval_setting, 1) if self.check_interval_setting else 1
+        if now - self._state['checked_at'] > check_interval:
+            generations = get_generations(*self.generations)
+            if generations != self._state['generations']:
+                self._values.clear()
+                self._state['generations'] = generations
+            self._state['checked_at'] = now
+
+        value = self._values.get(key)
+        if value is None:
+            value = self._values[key] = build()
+        return value
+
+    def clear(self):
+        self._values.clear()
+        self._state['checked_at'] = 0
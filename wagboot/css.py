@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Compilation of stylesheets (see wagboot.models.Css).
+
+Compiled css is cached by hash of the source and compiler options, so validation and saving
+of a stylesheet compile it once.
+Compiled stylesheets are written to the default storage as content-addressed files,
+so they can be served with "immutable" cache headers.
+
+Settings:
+  - WAGBOOT_SASS_OPTIONS: dict of additional keyword arguments for sass.compile() (default: {})
+  - WAGBOOT_INLINE_CSS: if True, compiled css is inlined into every page instead (default: False)
+"""
+from __future__ import absolute_import, unicode_literals
+
+import gzip
+import hashlib
+import io
+import re
+
+import sass
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils.encoding import force_bytes, force_text
+
+from wagboot.cache import get_cache, get_timeout, make_key
+
+CSS_DIRECTORY = 'wagboot/css'
+CSS_FILE_NAME_RE = re.compile(r'^[0-9a-f]{40}\.css$')
+
+
+def get_sass_options():
+    return getattr(settings, 'WAGBOOT_SASS_OPTIONS', {})
+
+
+def _get_compile_cache_key(source):
+    options = sorted(get_sass_options().items())
+    signature = '{}\n{}\n{}'.format(getattr(sass, '__version__', ''), options, source)
+    return make_key('sass', hashlib.sha1(force_bytes(signature)).hexdigest())
+
+
+def compile_css_uncached(source):
+    """
+    Compiles sass source with WAGBOOT_SASS_OPTIONS.
+    :raises sass.CompileError
+    """
+    return sass.compile(string=source or "", **get_sass_options())
+
+
+def store_compiled_css(source, compiled_css=None, error=None):
+    """
+    Puts result of compilation of the source to the cache.
+    :param compiled_css: compiled css (if compiled)
+    :param error: error message of the sass.CompileError (if compilation failed)
+    """
+    get_cache().set(_get_compile_cache_key(source), (compiled_css, error), get_timeout())
+
+
+def compile_css(source):
+    """
+    Compiles sass source, results (including compile errors) are cached.
+    :raises sass.CompileError
+    """
+    cached = get_cache().get(_get_compile_cache_key(source))
+    if cached is None:
+        try:
+            compiled_css = compile_css_uncached(source)
+        except sass.CompileError as e:
+            store_compiled_css(source, error=force_text(e))
+            raise
+        store_compiled_css(source, compiled_css=compiled_css)
+        return compiled_css
+
+    compiled_css, error = cached
+    if error is not None:
+        raise sass.CompileError(error)
+    return compiled_css
+
+
+def get_css_path(file_name):
+    return '{}/{}'.format(CSS_DIRECTORY, file_name)
+
+
+def _gzip(content):
+    buf = io.BytesIO()
+    # mtime is fixed to get the same .gz for the same css
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as gz_file:
+        gz_file.write(content)
+    return buf.getvalue()
+
+
+def write_compiled_css(compiled_css):
+    """
+    Saves compiled css to the storage as <sha1 of content>.css and .css.gz next to it.
+    Files which already exist are not rewritten.
+
+    :return: name of the file (without directory)
+    """
+    content = force_bytes(compiled_css or "")
+    file_name = '{}.css'.format(hashlib.sha1(content).hexdigest())
+    path = get_css_path(file_name)
+
+    if not default_storage.exists(path):
+        default_storage.save(path, ContentFile(content))
+    if not default_storage.exists(path + '.gz'):
+        default_storage.save(path + '.gz', ContentFile(_gzip(content)))
+    return file_name
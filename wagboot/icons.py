@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Website icons (favicon and touch icons) made of WebsiteSettings.square_logo.
+
+All renditions are generated once and the resulting <link> tags are cached per site
+(invalidated with settings), so rendering the page head does not look up renditions.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from django.utils.html import format_html_join
+from django.utils.safestring import mark_safe
+from wagtail.wagtailimages.models import SourceImageIOError
+
+from wagboot.cache import get_cache, get_generation, get_timeout, make_key, GENERATION_SETTINGS
+
+# (filter spec, <link> attributes except href)
+ICONS = [
+    ('max-16x16', 'type="image/vnd.microsoft.icon" rel="shortcut icon" sizes="16x16" title="favicon"'),
+    ('max-180x180', 'type="image/png" rel="apple-touch-icon" sizes="180x180"'),
+    ('max-152x152', 'type="image/png" rel="apple-touch-icon" sizes="152x152"'),
+    ('max-120x120', 'type="image/png" rel="apple-touch-icon" sizes="120x120"'),
+    ('max-114x114', 'type="image/png" rel="apple-touch-icon" sizes="114x114"'),
+    ('max-76x76', 'type="image/png" rel="apple-touch-icon" sizes="76x76"'),
+    ('max-72x72', 'type="image/png" rel="apple-touch-icon" sizes="72x72"'),
+    ('max-57x57', 'type="image/png" rel="apple-touch-icon"'),
+    ('original', 'type="image/png" rel="icon" sizes="all"'),
+]
+
+try:
+    from wagtail.wagtailimages.shortcuts import get_rendition_or_not_found
+except ImportError:
+    # Wagtail < 1.8
+    def get_rendition_or_not_found(image, specs):
+        """
+        Returns rendition of the image, or a "not-found" rendition if the file of the image is missing
+        (the same as {% image %} tag does).
+        """
+        try:
+            return image.get_rendition(specs)
+        except SourceImageIOError:
+            rendition = image.renditions.model(image=image, width=0, height=0)
+            rendition.file.name = 'not-found'
+            return rendition
+
+
+def render_site_icons(square_logo):
+    """
+    Generates all icon renditions of the image.
+    :return: html with <link> tags
+    """
+    if not square_logo:
+        return ''
+    links = ((get_rendition_or_not_found(square_logo, spec).url, mark_safe(attrs)) for spec, attrs in ICONS)
+    return format_html_join('\n', '<link href="{}" {}/>', links)
+
+
+def get_site_icons(site):
+    """
+    Returns cached <link> tags of icons for the site.
+    """
+    from wagboot.models import WebsiteSettings
+
+    cache = get_cache()
+    key = make_key(GENERATION_SETTINGS, get_generation(GENERATION_SETTINGS), 'icons', site.pk)
+    icons = cache.get(key)
+    if icons is None:
+        icons = render_site_icons(WebsiteSettings.get_attr_for_site('square_logo', site))
+        cache.set(key, icons, get_timeout())
+    return mark_safe(icons)
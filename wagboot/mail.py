@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Delivery of emails sent by wagboot (password reset links etc.).
+
+Delivery backend is set by WAGBOOT_EMAIL_DELIVERY setting (dotted path to the class):
+  - 'wagboot.mail.ImmediateDelivery' (default): sends email during the request
+  - 'wagboot.mail.QueuedDelivery': puts email into in-process queue, background thread sends
+    queued emails in batches over one connection of the EMAIL_BACKEND, with retries
+
+QueuedDelivery settings:
+  - WAGBOOT_EMAIL_BATCH_SIZE: max emails sent over one connection (default: 50)
+  - WAGBOOT_EMAIL_BATCH_WAIT: seconds to wait for more emails to fill the batch (default: 0.5)
+  - WAGBOOT_EMAIL_MAX_RETRIES: retries of failed email before dropping it (default: 3)
+  - WAGBOOT_EMAIL_RETRY_DELAY: seconds before the first retry, doubled for every next one (default: 5)
+
+To try it locally run SMTP stand-in, which prints emails instead of sending them:
+
+    python -m smtpd -n -c DebuggingServer localhost:1025
+
+and set EMAIL_HOST = 'localhost', EMAIL_PORT = 1025.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import atexit
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.utils.module_loading import import_string
+from six.moves import queue
+
+logger = logging.getLogger(__name__)
+
+
+class BaseDelivery(object):
+    def send(self, message):
+        """
+        :type message: django.core.mail.EmailMessage
+        """
+        raise NotImplementedError()
+
+
+class ImmediateDelivery(BaseDelivery):
+    def send(self, message):
+        message.send()
+
+
+class QueuedDelivery(BaseDelivery):
+    """
+    Sends emails from background thread.
+    Failed emails wait for their retry outside of the queue, so they do not hold up new emails.
+    Emails still in the queue are lost if process is killed, at normal exit sending is waited for.
+    """
+
+    def __init__(self):
+        self.batch_size = getattr(settings, 'WAGBOOT_EMAIL_BATCH_SIZE', 50)
+        self.batch_wait = getattr(settings, 'WAGBOOT_EMAIL_BATCH_WAIT', 0.5)
+        self.max_retries = getattr(settings, 'WAGBOOT_EMAIL_MAX_RETRIES', 3)
+        self.retry_delay = getattr(settings, 'WAGBOOT_EMAIL_RETRY_DELAY', 5)
+        self.metrics = {'queued': 0, 'sent': 0, 'retried': 0, 'failed': 0, 'batches': 0}
+        self._queue = queue.Queue()
+        # Heap of (not_before, sequence number, message, retries) of failed emails
+        self._retries = []
+        self._retry_counter = itertools.count()
+        # Number of emails in the batch being sent
+        self._sending = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        atexit.register(self.flush)
+
+    def send(self, message):
+        self._ensure_thread()
+        with self._lock:
+            self.metrics['queued'] += 1
+        self._queue.put(message)
+
+    def _is_pending(self):
+        with self._lock:
+            return bool(self._queue.unfinished_tasks or self._retries or self._sending)
+
+    def flush(self, timeout=30):
+        """
+        Waits until all queued emails are sent (or failed), at most timeout seconds.
+        :return: True if there are no emails to send
+        """
+        waiting_until = time.time() + timeout
+        while self._is_pending() and time.time() < waiting_until:
+            time.sleep(0.05)
+        return not self._is_pending()
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="wagboot-email-delivery")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _next_retry_in(self):
+        """
+        :return: seconds until the next retry is due, None if there are no retries
+        """
+        with self._lock:
+            if not self._retries:
+                return None
+            return max(self._retries[0][0] - time.time(), 0)
+
+    def _pop_due_retries(self):
+        due = []
+        now = time.time()
+        with self._lock:
+            while self._retries and self._retries[0][0] <= now and len(due) < self.batch_size:
+                not_before, number, message, retries = heapq.heappop(self._retries)
+                due.append((message, retries))
+            self._sending += len(due)
+        return due
+
+    def _get_batch(self):
+        """
+        Waits for new emails or for the next due retry.
+        :return: (list of (message, retries), number of emails taken from the queue)
+        """
+        batch = self._pop_due_retries()
+        taken = 0
+        if not batch:
+            try:
+                batch.append((self._queue.get(timeout=self._next_retry_in()), 0))
+                taken = 1
+            except queue.Empty:
+                # Retry is due
+                return self._pop_due_retries(), 0
+
+        waiting_until = time.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = waiting_until - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append((self._queue.get(timeout=remaining), 0))
+                taken += 1
+            except queue.Empty:
+                break
+        return batch, taken
+
+    def _run(self):
+        while True:
+            batch, taken = self._get_batch()
+            try:
+                self._send_batch(batch)
+            except Exception:
+                logger.exception("Unexpected error while sending emails")
+            finally:
+                with self._lock:
+                    self._sending = 0
+                for _ in range(taken):
+                    self._queue.task_done()
+
+    def _send_batch(self, batch):
+        if not batch:
+            return
+        with self._lock:
+            self.metrics['batches'] += 1
+        connection = None
+        try:
+            for message, retries in batch:
+                try:
+                    if connection is None:
+                        connection = get_connection()
+                        connection.open()
+                    connection.send_messages([message])
+                except Exception:
+                    self._retry(message, retries)
+                    # Connection may be broken, next email will open new one
+                    self._close(connection)
+                    connection = None
+                else:
+                    with self._lock:
+                        self.metrics['sent'] += 1
+        finally:
+            self._close(connection)
+
+    def _close(self, connection):
+        if connection is None:
+            return
+        try:
+            connection.close()
+        except Exception:
+            logger.warning("Could not close email connection", exc_info=True)
+
+    def _retry(self, message, retries):
+        if retries >= self.max_retries:
+            logger.exception("Email to %s failed, giving up", message.to)
+            with self._lock:
+                self.metrics['failed'] += 1
+            return
+        logger.warning("Email to %s failed, will retry", message.to, exc_info=True)
+        with self._lock:
+            self.metrics['retried'] += 1
+            heapq.heappush(self._retries, (time.time() + self.retry_delay * 2 ** retries,
+                                           next(self._retry_counter), message, retries + 1))
+
+
+_delivery = None
+_delivery_lock = threading.Lock()
+
+
+def get_delivery():
+    """
+    :rtype: BaseDelivery
+    """
+    global _delivery
+    with _delivery_lock:
+        if _delivery is None:
+            _delivery = import_string(getattr(settings, 'WAGBOOT_EMAIL_DELIVERY', 'wagboot.mail.ImmediateDelivery'))()
+        return _delivery
+
+
+def send_email(message):
+    """
+    Sends email with configured delivery backend.
+    :type message: django.core.mail.EmailMessage
+    """
+    get_delivery().send(message)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils.encoding import force_text
+
+from wagboot.css import compile_css_uncached, store_compiled_css
+from wagboot.models import Css
+
+
+def _compile(job):
+    """
+    Runs in the worker process, must not use database or cache.
+    """
+    pk, source = job
+    started = time.time()
+    try:
+        compiled_css, error = compile_css_uncached(source), None
+    except Exception as e:
+        compiled_css, error = None, force_text(e)
+    return pk, compiled_css, error, time.time() - started
+
+
+class Command(BaseCommand):
+    help = "Recompiles all CSS stylesheets (e.g. after libsass upgrade) using a pool of processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None,
+                            help="Number of worker processes (default: number of CPUs)")
+
+    def handle(self, *args, **options):
+        stylesheets = dict((pk, (name, source)) for pk, name, source in Css.objects.values_list('pk', 'name', 'css'))
+        if not stylesheets:
+            self.stdout.write("No stylesheets to compile")
+            return
+
+        # Forked workers must not share database connections with this process
+        for connection in connections.all():
+            connection.close()
+
+        started = time.time()
+        pool = multiprocessing.Pool(processes=options['processes'])
+        try:
+            results = pool.map(_compile, [(pk, source) for pk, (name, source) in stylesheets.items()])
+        finally:
+            pool.close()
+            pool.join()
+        compile_time = time.time() - started
+
+        errors = 0
+        for pk, compiled_css, error, seconds in sorted(results, key=lambda result: -result[3]):
+            name, source = stylesheets[pk]
+            store_compiled_css(source, compiled_css=compiled_css, error=error)
+            css = Css.objects.filter(pk=pk).first()
+            if css is None:
+                self.stdout.write("{:>8.3f}s  {} (id={}) was deleted, skipped".format(seconds, name, pk))
+                continue
+            if css.css == source:
+                css.save(compiled_css=compiled_css if error is None else "/*{}*/".format(error))
+            else:
+                # Edited during the run, compile the new source
+                css.save()
+            if error is None:
+                self.stdout.write("{:>8.3f}s  {} (id={})".format(seconds, name, pk))
+            else:
+                errors += 1
+                self.stderr.write("{:>8.3f}s  {} (id={}) FAILED: {}".format(seconds, name, pk, error))
+
+        self.stdout.write("Compiled {} stylesheet(s) in {:.3f}s ({:.3f}s total), {} error(s)".format(
+            len(results), compile_time, time.time() - started, errors))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from wagtail.wagtailcore.models import Page
+
+from wagboot.renditions import generate_renditions, get_page_renditions
+
+
+def _init_worker():
+    # Forked workers must not use database connections of the parent process
+    for connection in connections.all():
+        connection.close()
+
+
+def _generate(job):
+    """
+    Runs in the worker process.
+    :return: (number of renditions, number of errors)
+    """
+    image_id, specs = job
+    return len(specs), generate_renditions((image_id, spec) for spec in specs)
+
+
+class Command(BaseCommand):
+    help = "Generates renditions of images used by live pages (blocks and rich text) using a pool of processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None,
+                            help="Number of worker processes (default: number of CPUs)")
+
+    def handle(self, *args, **options):
+        started = time.time()
+        specs_by_image = {}
+        pages = 0
+        for page in Page.objects.live().iterator():
+            pages += 1
+            for image_id, spec in get_page_renditions(page):
+                specs_by_image.setdefault(image_id, set()).add(spec)
+        self.stdout.write("Found {} image(s) on {} page(s)".format(len(specs_by_image), pages))
+        if not specs_by_image:
+            return
+
+        _init_worker()
+        pool = multiprocessing.Pool(processes=options['processes'], initializer=_init_worker)
+        renditions = errors = 0
+        try:
+            # Images are split between workers, so two workers do not generate the same rendition
+            for count, failed in pool.imap_unordered(_generate, sorted(specs_by_image.items())):
+                renditions += count
+                errors += failed
+        finally:
+            pool.close()
+            pool.join()
+
+        self.stdout.write("Checked {} rendition(s) in {:.3f}s, {} error(s)".format(
+            renditions, time.time() - started, errors))
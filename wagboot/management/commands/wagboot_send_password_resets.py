@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import io
+import multiprocessing
+import os
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils.encoding import force_text
+from wagtail.wagtailcore.models import Page, Site
+
+from wagboot.blocks import PasswordResetBlock
+
+# State of the worker process, set by _init_worker
+_worker = {}
+
+
+def find_password_reset_block(page):
+    """
+    Returns (block, block_value) of the first PasswordResetBlock on the page.
+    """
+    for child in getattr(page.specific, 'body', None) or ():
+        if isinstance(child.block, PasswordResetBlock):
+            return child.block, child.value
+    raise CommandError("Page {} has no password reset block".format(page.pk))
+
+
+def _init_worker(page_id):
+    page = Page.objects.get(pk=page_id)
+    site_id, root_url, path = page.get_url_parts()
+    _worker['block'], _worker['block_value'] = find_password_reset_block(page)
+    _worker['site'] = Site.objects.get(pk=site_id)
+    _worker['path'] = path
+    # One connection per worker, reused for all its batches
+    _worker['connection'] = None
+    _reconnect()
+
+
+def _reconnect():
+    if _worker['connection'] is not None:
+        try:
+            _worker['connection'].close()
+        except Exception:
+            pass
+    _worker['connection'] = get_connection()
+    try:
+        _worker['connection'].open()
+    except Exception:
+        # Will be tried again by the next message
+        pass
+
+
+def _send_batch(user_pks):
+    """
+    Runs in the worker process.
+    :return: (pks of users who got the email, list of (pk, error))
+    """
+    block = _worker['block']
+    sent, errors = [], []
+    for user in get_user_model()._default_manager.filter(pk__in=user_pks):
+        try:
+            message = block.build_reset_message(user, _worker['block_value'], _worker['site'], _worker['path'])
+            message.connection = _worker['connection']
+            message.send()
+        except Exception as e:
+            errors.append((user.pk, force_text(e)))
+            # Connection may be broken
+            _reconnect()
+        else:
+            sent.append(user.pk)
+    return sent, errors
+
+
+class Command(BaseCommand):
+    help = "Sends password reset emails (e.g. invitations) to many users, using templates and texts of " \
+           "the password reset block on the given page"
+
+    def add_arguments(self, parser):
+        parser.add_argument('page_id', type=int, help="Page with password reset block")
+        parser.add_argument('--emails-file',
+                            help="File with emails of users, one per line (default: all active users)")
+        parser.add_argument('--state-file',
+                            help="File to record users who got the email, they are skipped when command "
+                                 "is run again with the same file (to resume after failure)")
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--processes', type=int, default=None,
+                            help="Number of worker processes (default: number of CPUs)")
+
+    def handle(self, *args, **options):
+        page = Page.objects.filter(pk=options['page_id']).first()
+        if page is None:
+            raise CommandError("Page {} does not exist".format(options['page_id']))
+        find_password_reset_block(page)
+
+        users = get_user_model()._default_manager.filter(is_active=True).exclude(email='')
+        if options['emails_file']:
+            with io.open(options['emails_file'], encoding='utf-8') as emails_file:
+                emails = [line.strip() for line in emails_file if line.strip()]
+            users = users.filter(email__in=emails)
+        user_pks = list(users.order_by('pk').values_list('pk', flat=True))
+
+        done = set()
+        state_file = options['state_file']
+        if state_file and os.path.exists(state_file):
+            with io.open(state_file, encoding='utf-8') as f:
+                done = set(line.strip() for line in f if line.strip())
+        user_pks = [pk for pk in user_pks if force_text(pk) not in done]
+        if done:
+            self.stdout.write("Skipping {} user(s) from {}".format(len(done), state_file))
+
+        batch_size = options['batch_size']
+        batches = [user_pks[i:i + batch_size] for i in range(0, len(user_pks), batch_size)]
+        self.stdout.write("Sending {} email(s) in {} batch(es)".format(len(user_pks), len(batches)))
+
+        # Forked workers must not share database connections with this process
+        for connection in connections.all():
+            connection.close()
+
+        started = time.time()
+        sent_count = error_count = 0
+        pool = multiprocessing.Pool(processes=options['processes'], initializer=_init_worker,
+                                    initargs=(page.pk,))
+        try:
+            for sent, errors in pool.imap_unordered(_send_batch, batches):
+                sent_count += len(sent)
+                error_count += len(errors)
+                if state_file and sent:
+                    with io.open(state_file, 'a', encoding='utf-8') as f:
+                        f.write(''.join('{}\n'.format(pk) for pk in sent))
+                for pk, error in errors:
+                    self.stderr.write("User {}: {}".format(pk, error))
+                elapsed = time.time() - started
+                self.stdout.write("Sent {}/{} ({} error(s)), {:.1f} emails/s".format(
+                    sent_count, len(user_pks), error_count, sent_count / elapsed if elapsed else 0))
+        finally:
+            pool.close()
+            pool.join()
+
+        if error_count:
+            raise CommandError("{} email(s) failed, run the command again with the same --state-file "
+                               "to retry them".format(error_count))
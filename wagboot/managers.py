@@ -3,11 +3,31 @@ from __future__ import absolute_import, unicode_literals
 
 from django.db import models
 
+from wagboot.cache import get_cache, get_generation, get_timeout, make_key, GENERATION_MENUS
+
 
 class MenuManager(models.Manager):
     def get_by_natural_key(self, name):
         return self.get(menu_name=name)
 
+    def get_cached(self, pk):
+        """
+        Returns menu by its pk from the cache (or database on cache miss).
+        Cached menus are invalidated by signals (see wagboot.signals).
+        :return: Menu or None
+        """
+        if not pk:
+            return None
+        cache = get_cache()
+        key = make_key(GENERATION_MENUS, get_generation(GENERATION_MENUS), 'menu', pk)
+        menu = cache.get(key)
+        if menu is None:
+            menu = self.filter(pk=pk).first()
+            if menu is None:
+                return None
+            cache.set(key, menu, get_timeout())
+        return menu
+
 
 class CssManager(models.Manager):
     def get_by_natural_key(self, name):
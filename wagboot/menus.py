@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, picklable snapshots of menus.
+
+Menu templates render snapshots instead of Menu/MenuItem models, so rendering a menu does not
+load menu items, linked pages and documents and does not compute page urls.
+Snapshots are stored in the cache (see Menu.get_snapshot()).
+"""
+from __future__ import absolute_import, unicode_literals
+
+from django.utils.encoding import force_text
+
+
+class MenuItemSnapshot(object):
+    __slots__ = ('href', 'label')
+
+    def __init__(self, href, label):
+        self.href = href
+        self.label = label
+
+    def __str__(self):
+        return self.label
+
+    __unicode__ = __str__
+
+
+class MenuSnapshot(object):
+    """
+    Resolved data of the menu:
+      - items: tuple of MenuItemSnapshot
+      - cta_href, cta_label: call-to-action link, both are None if menu has no CTA
+    """
+    __slots__ = ('pk', 'name', 'items', 'cta_href', 'cta_label')
+
+    def __init__(self, pk, name, items, cta_href=None, cta_label=None):
+        self.pk = pk
+        self.name = name
+        self.items = items
+        self.cta_href = cta_href
+        self.cta_label = cta_label
+
+    @classmethod
+    def from_menu(cls, menu):
+        """
+        :type menu: wagboot.models.Menu
+        """
+        items = tuple(MenuItemSnapshot(href=item.link, label=force_text(item))
+                      for item in menu.items.select_related('link_page', 'link_document'))
+
+        cta_href = cta_label = None
+        if menu.cta_page:
+            cta_href = menu.cta_page.url
+            cta_label = menu.cta_name or menu.cta_page.title
+        elif menu.cta_url and menu.cta_name:
+            cta_href = menu.cta_url
+            cta_label = menu.cta_name
+
+        return cls(pk=menu.pk, name=menu.name, items=items, cta_href=cta_href, cta_label=cta_label)
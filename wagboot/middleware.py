@@ -2,8 +2,13 @@
 from __future__ import absolute_import, unicode_literals
 
 import django
+from django.contrib.auth.views import redirect_to_login
+from django.http import HttpResponseRedirect
+from django.utils.cache import add_never_cache_headers
 
-from wagboot.redirects import extract_redirect_data_from_request
+from wagboot.aliases import get_alias_target
+from wagboot.redirects import extract_redirect_data_from_request, RedirectRequested
+from wagboot.restricted import get_login_url, get_restricted_page_url
 
 if django.VERSION >= (1, 10):
     from django.utils.deprecation import MiddlewareMixin
@@ -17,3 +22,39 @@ class RedirectMiddleware(MiddlewareMixin):
         if redirect:
             return redirect
         return response
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, RedirectRequested):
+            return extract_redirect_data_from_request(request)
+
+
+class AliasMiddleware(MiddlewareMixin):
+    """
+    Redirects requests for alias pages without routing them through the page tree (see wagboot.aliases).
+    Must be after wagtail's SiteMiddleware.
+    """
+
+    def process_request(self, request):
+        if request.method not in ('GET', 'HEAD') or getattr(request, 'site', None) is None:
+            return None
+        target_url = get_alias_target(request.site, request.path)
+        if target_url:
+            return HttpResponseRedirect(target_url)
+        return None
+
+
+class RestrictedPageMiddleware(MiddlewareMixin):
+    """
+    Redirects anonymous visitors of restricted pages to login without routing them through the page tree
+    (see wagboot.restricted). Must be after wagtail's SiteMiddleware and django's AuthenticationMiddleware.
+    """
+
+    def process_request(self, request):
+        if getattr(request, 'site', None) is None:
+            return None
+        page_url = get_restricted_page_url(request.site, request.path)
+        if page_url is None or request.user.is_authenticated():
+            return None
+        response = redirect_to_login(page_url, login_url=get_login_url(request.site))
+        add_never_cache_headers(response)
+        return response
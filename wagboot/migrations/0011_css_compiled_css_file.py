@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wagboot', '0010_auto_20160718_1333'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='css',
+            name='_compiled_css_file',
+            field=models.CharField(max_length=255, null=True, editable=False, blank=True),
+        ),
+    ]
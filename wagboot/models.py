@@ -1,13 +1,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
+import copy
+import logging
 from email.utils import formataddr
 
 import sass
+from django.conf import settings
 from django.contrib.auth.views import redirect_to_login
 from django.core.exceptions import ValidationError
+from django.core.urlresolvers import reverse, NoReverseMatch
 from django.db import models
 from django.shortcuts import redirect
+from django.utils.cache import patch_cache_control
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import never_cache
 from django_ace import AceWidget
@@ -18,7 +23,7 @@ from wagtail.contrib.settings.models import BaseSetting
 from wagtail.contrib.settings.registry import register_setting
 from wagtail.wagtailadmin.edit_handlers import FieldPanel, StreamFieldPanel, InlinePanel, PageChooserPanel
 from wagtail.wagtailcore.fields import RichTextField
-from wagtail.wagtailcore.models import Page, Orderable
+from wagtail.wagtailcore.models import Page, Orderable, get_page_models
 from wagtail.wagtaildocs.edit_handlers import DocumentChooserPanel
 from wagtail.wagtailimages.edit_handlers import ImageChooserPanel
 from wagtail.wagtailsnippets.edit_handlers import SnippetChooserPanel
@@ -26,7 +31,17 @@ from wagtail.wagtailsnippets.models import register_snippet
 
 from wagboot import blocks
 from wagboot import choices
+from wagboot import page_cache
+from wagboot import rendering
+from wagboot.cache import get_cache, get_generation, get_timeout, make_key, ProcessCache, GENERATION_MENUS, \
+    GENERATION_SETTINGS
+from wagboot.css import compile_css, write_compiled_css
 from wagboot.managers import MenuManager, CssManager
+from wagboot.menus import MenuSnapshot
+from wagboot.redirects import serve_with_redirects
+from wagboot.restricted import get_login_url
+
+logger = logging.getLogger(__name__)
 
 
 @python_2_unicode_compatible
@@ -102,6 +117,22 @@ class Menu(ClusterableModel):
     def __str__(self):
         return self.name
 
+    def get_snapshot(self):
+        """
+        Returns MenuSnapshot to render this menu with, from cache if possible.
+        Cached snapshots are invalidated by signals (see wagboot.signals).
+        :return: MenuSnapshot
+        """
+        if not self.pk:
+            return MenuSnapshot.from_menu(self)
+        cache = get_cache()
+        key = make_key(GENERATION_MENUS, get_generation(GENERATION_MENUS), 'snapshot', self.pk)
+        snapshot = cache.get(key)
+        if snapshot is None:
+            snapshot = MenuSnapshot.from_menu(self)
+            cache.set(key, snapshot, get_timeout())
+        return snapshot
+
     panels = [
         FieldPanel('name', classname='full title'),
         InlinePanel('items', label="Menu Items", min_num=1),
@@ -129,6 +160,7 @@ class Css(ClusterableModel):
     name = models.CharField(max_length=255, null=False, blank=False)
     css = models.TextField(blank=True, null=True)
     _compiled_css = models.TextField(blank=True, null=True, editable=False)
+    _compiled_css_file = models.CharField(max_length=255, blank=True, null=True, editable=False)
 
     class Meta(object):
         verbose_name = 'CSS stylesheet'
@@ -148,17 +180,40 @@ class Css(ClusterableModel):
     def get_css(self):
         return self._compiled_css
 
+    def get_css_url(self):
+        """
+        Url of compiled css file (served with immutable cache headers).
+        :return: url or None if css should be inlined into the page (no file, or WAGBOOT_INLINE_CSS is set)
+        """
+        if getattr(settings, 'WAGBOOT_INLINE_CSS', False) or not self._compiled_css_file:
+            return None
+        try:
+            return reverse('compiled_css', kwargs={'file_name': self._compiled_css_file})
+        except NoReverseMatch:
+            # wagboot.urls are not included
+            return None
+
     def full_clean(self, exclude=None, validate_unique=True):
         try:
-            sass.compile(string=self.css or "")
+            compile_css(self.css)
         except sass.CompileError as e:
             raise ValidationError({'css': "{}".format(e)})
 
-    def save(self, **kwargs):
+    def save(self, compiled_css=None, **kwargs):
+        """
+        :param compiled_css: self.css already compiled (e.g. by wagboot_compile_css command)
+        """
+        if compiled_css is None:
+            try:
+                compiled_css = compile_css(self.css)
+            except Exception as e:
+                compiled_css = "/*{}*/".format(e)
+        self._compiled_css = compiled_css
         try:
-            self._compiled_css = sass.compile(string=self.css or "")
-        except Exception as e:
-            self._compiled_css = "/*{}*/".format(e)
+            self._compiled_css_file = write_compiled_css(self._compiled_css)
+        except Exception:
+            logger.exception("Could not write compiled css file, it will be inlined")
+            self._compiled_css_file = None
         super(Css, self).save(**kwargs)
 
 try:
@@ -169,7 +224,40 @@ except ImportError:
     pass
 
 
+_settings_instances = ProcessCache(GENERATION_SETTINGS, 'WAGBOOT_SETTINGS_CHECK_INTERVAL')
+
+
+def clear_settings_cache():
+    """
+    Clears settings kept in memory of this process (other processes are notified by settings generation).
+    """
+    _settings_instances.clear()
+
+
 class SettingsMixin(object):
+    """
+    Keeps settings per site in process memory, together with related objects from for_site_select_related.
+
+    Processes reload settings when settings generation changes (see wagboot.signals),
+    generation is checked at most once per WAGBOOT_SETTINGS_CHECK_INTERVAL seconds (default: 1).
+    """
+
+    for_site_select_related = ()
+
+    @classmethod
+    def for_site(cls, site):
+        if site is None:
+            return super(SettingsMixin, cls).for_site(site)
+
+        def load():
+            instance = cls.objects.select_related(*cls.for_site_select_related).filter(site=site).first()
+            if instance is None:
+                instance = super(SettingsMixin, cls).for_site(site)
+            return instance
+
+        instance = _settings_instances.get((cls, site.pk), load)
+        # Copy, so changes of the instance (e.g. by settings edit form) are not shared
+        return copy.copy(instance)
 
     @classmethod
     def get_attr_for_site(cls, attr, site):
@@ -216,6 +304,9 @@ class WebsiteSettings(SettingsMixin, BaseSetting):
                                                                     "user (password resets, etc.)")
     notifications_email = models.EmailField(blank=True, null=True, help_text="For system notifications")
 
+    # login_page is resolved by get_login_url(), so settings do not change with pages
+    for_site_select_related = ('default_css', 'menu_logo', 'square_logo')
+
     panels = [
         SnippetChooserPanel('default_css'),
         FieldPanel('bottom_extra_content', classname="full"),
@@ -236,9 +327,15 @@ class WebsiteSettings(SettingsMixin, BaseSetting):
 
     @classmethod
     def get_login_url(cls, site):
-        login_page = cls.get_attr_for_site('login_page', site)
-        if login_page:
-            return login_page.url
+        """
+        Returns current url of the login page, None if it is not set.
+        Use wagboot.restricted.get_login_url(), which keeps it in memory.
+        """
+        login_page_id = cls.get_attr_for_site('login_page_id', site)
+        if login_page_id:
+            login_page = Page.objects.filter(pk=login_page_id).first()
+            if login_page:
+                return login_page.url
         return None
 
     @classmethod
@@ -277,6 +374,18 @@ class BaseGenericPage(Page):
     bottom_menu = models.ForeignKey(Menu, null=True, blank=True, on_delete=models.SET_NULL, related_name='+',
                                     help_text="Specific bottom menu for this and child pages")
 
+    # Seconds to cache html of the page for anonymous visitors (see wagboot.page_cache),
+    # None - use WAGBOOT_PAGE_CACHE_TIMEOUT setting, 0 - do not cache
+    page_cache_timeout = None
+
+    # Whether html of content blocks can be cached (see wagboot.rendering)
+    block_cache_enabled = True
+    # Whether only blocks declaring wagboot_depends_on = DEPENDS_ON_NOTHING can be cached
+    block_cache_declared_only = False
+
+    # Whether blocks can be rendered concurrently in a pool of threads (see wagboot.rendering)
+    render_blocks_concurrently = False
+
     class Meta(object):
         abstract = True
 
@@ -300,33 +409,72 @@ class BaseGenericPage(Page):
 
         return context
 
+    def serve(self, request, *args, **kwargs):
+        timeout = self.page_cache_timeout
+        if timeout is None:
+            timeout = page_cache.get_page_cache_timeout()
+        if timeout and self.is_page_cacheable() and page_cache.is_request_cacheable(request):
+            return page_cache.serve_cached(
+                request, lambda: super(BaseGenericPage, self).serve(request, *args, **kwargs), timeout)
+        # Rendering stops at the block which redirects (e.g. after successful login)
+        return serve_with_redirects(request, lambda: super(BaseGenericPage, self).serve(request, *args, **kwargs))
+
+    def is_page_cacheable(self):
+        """
+        Html of the page can be cached if all its blocks (including nested ones) render the same
+        for all visitors, so pages with form (and other user or request dependent) blocks are not cached.
+        """
+        return all(rendering.is_value_cacheable(child.block, child.value, self.block_cache_declared_only)
+                   for child in getattr(self, 'body', None) or ())
+
     def get_top_menu(self):
         """
         Goes up the hierarchy of pages and gets first top_menu.
         :return: Menu
         """
-        page = self
-        for safety in range(100):
-            if not page:
-                return
-            top_menu = getattr(page.specific, 'top_menu', None)
-            if top_menu:
-                return top_menu
-            page = page.get_parent()
+        return Menu.objects.get_cached(self.top_menu_id or self._get_inherited_menu_ids()[0])
 
     def get_bottom_menu(self):
         """
         Goes up the hierarchy of pages and gets first bottom_menu.
         :return: Menu
         """
-        page = self
-        for safety in range(100):
-            if not page:
-                return
-            bottom_menu = getattr(page.specific, 'bottom_menu', None)
-            if bottom_menu:
-                return bottom_menu
-            page = page.get_parent()
+        return Menu.objects.get_cached(self.bottom_menu_id or self._get_inherited_menu_ids()[1])
+
+    def _get_inherited_menu_ids(self):
+        """
+        Returns ids of the first top and bottom menus set on the ancestors of this page.
+
+        All ancestors are fetched in one query per generic page model (not per level of the tree).
+        Result is cached per parent page, cache is invalidated by signals (see wagboot.signals).
+        :return: (top_menu_id, bottom_menu_id)
+        """
+        parent_path = self.path[:-self.steplen]
+        if not parent_path:
+            return None, None
+
+        cache = get_cache()
+        key = make_key(GENERATION_MENUS, get_generation(GENERATION_MENUS), 'inherited', parent_path)
+        menu_ids = cache.get(key)
+        if menu_ids is None:
+            ancestor_paths = [parent_path[:end] for end in range(self.steplen, len(parent_path) + 1, self.steplen)]
+            menus_by_path = {}
+            for model in get_page_models():
+                if issubclass(model, BaseGenericPage):
+                    menus_by_path.update(
+                        (path, (top_menu_id, bottom_menu_id))
+                        for path, top_menu_id, bottom_menu_id in model.objects.filter(
+                            path__in=ancestor_paths).values_list('path', 'top_menu_id', 'bottom_menu_id'))
+
+            top_menu_id = bottom_menu_id = None
+            for path in reversed(ancestor_paths):
+                ancestor_top_menu_id, ancestor_bottom_menu_id = menus_by_path.get(path, (None, None))
+                top_menu_id = top_menu_id or ancestor_top_menu_id
+                bottom_menu_id = bottom_menu_id or ancestor_bottom_menu_id
+
+            menu_ids = (top_menu_id, bottom_menu_id)
+            cache.set(key, menu_ids, get_timeout())
+        return menu_ids
 
 
 class AbstractGenericPage(BaseGenericPage):
@@ -359,6 +507,10 @@ class AbstractRestrictedPage(BaseGenericPage):
     # You need to create body field like so:
     #     body = StreamField(BASE_BLOCKS + GENERIC_PAGE_BLOCKS + YOUR_CUSTOM_BLOCKS)
 
+    page_cache_timeout = 0
+    # Html of blocks is shared by all users, so only blocks declared as not depending on user are cached
+    block_cache_declared_only = True
+
     class Meta(object):
         abstract = True
 
@@ -366,8 +518,10 @@ class AbstractRestrictedPage(BaseGenericPage):
     @method_decorator(never_cache)
     def serve(self, request, *args, **kwargs):
         if not request.user.is_authenticated():
-            return redirect_to_login(self.url, login_url=WebsiteSettings.get_login_url(request.site))
-        return super(AbstractRestrictedPage, self).serve(request, *args, **kwargs)
+            return redirect_to_login(self.url, login_url=get_login_url(request.site))
+        response = super(AbstractRestrictedPage, self).serve(request, *args, **kwargs)
+        patch_cache_control(response, private=True)
+        return response
 
     def get_sitemap_urls(self):
         return []
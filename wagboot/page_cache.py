@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of whole pages rendered for anonymous visitors (see BaseGenericPage.serve).
+
+Html is cached per site and path, key includes generations of pages, menus, settings and images
+(so it changes when any page is published, moved or deleted, or any image is changed).
+Besides the fresh entry every page has a "stale" entry which is kept longer and is not
+invalidated. When the fresh entry is missing, only one worker renders the page (it takes a lock)
+while others serve the stale html (or wait for the fresh one if there is no stale html).
+
+Settings:
+  - WAGBOOT_PAGE_CACHE_TIMEOUT: seconds to keep fresh html, None disables the cache (default: None)
+  - WAGBOOT_PAGE_CACHE_LOCK_TIMEOUT: max seconds to render a page (default: 10)
+"""
+from __future__ import absolute_import, unicode_literals
+
+import time
+
+import six
+from django.conf import settings
+from django.contrib import messages
+from django.http import HttpResponse
+
+from wagboot.cache import get_cache, get_generations, get_timeout, make_key, GENERATION_IMAGES, GENERATION_MENUS, \
+    GENERATION_PAGES, GENERATION_SETTINGS
+from wagboot.redirects import extract_redirect_data_from_request
+
+WAIT_INTERVAL = 0.05
+
+
+def get_page_cache_timeout():
+    return getattr(settings, 'WAGBOOT_PAGE_CACHE_TIMEOUT', None)
+
+
+def _has_messages(request):
+    # len() does not mark messages as used
+    return bool(len(messages.get_messages(request)))
+
+
+def is_request_cacheable(request):
+    """
+    Only anonymous GETs without pending messages get cached html.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated():
+        return False
+    return not _has_messages(request)
+
+
+def _is_response_cacheable(request, response):
+    return (response.status_code == 200 and
+            not response.cookies and
+            not request.META.get('CSRF_COOKIE_USED') and
+            not extract_redirect_data_from_request(request) and
+            not _has_messages(request))
+
+
+def _make_entry(response):
+    # Cookies are not cached (responses with cookies are not cacheable)
+    return response.content, list(response.items())
+
+
+def _make_response(entry):
+    content, headers = entry
+    if isinstance(headers, six.string_types):
+        # Entry cached before headers were stored, it has only Content-Type
+        headers = [('Content-Type', headers)]
+    response = HttpResponse(content=content)
+    for name, value in headers:
+        response[name] = value
+    return response
+
+
+def serve_cached(request, render, timeout):
+    """
+    Returns cached response for the request, or renders it.
+    :param render: callable returning response of the page (can be not rendered TemplateResponse)
+    :param timeout: seconds to keep fresh html
+    """
+    cache = get_cache()
+    stale_key = make_key('page', request.site.pk, request.get_full_path())
+    generations = get_generations(GENERATION_PAGES, GENERATION_MENUS, GENERATION_SETTINGS, GENERATION_IMAGES)
+    key = make_key(stale_key, *generations)
+    lock_key = make_key(key, 'lock')
+    lock_timeout = getattr(settings, 'WAGBOOT_PAGE_CACHE_LOCK_TIMEOUT', 10)
+
+    entry = cache.get(key)
+    if entry is not None:
+        return _make_response(entry)
+
+    locked = cache.add(lock_key, 1, lock_timeout)
+    if not locked:
+        # Somebody is rendering this page right now
+        entry = cache.get(stale_key)
+        waiting_until = time.time() + lock_timeout
+        while entry is None and time.time() < waiting_until:
+            time.sleep(WAIT_INTERVAL)
+            values = cache.get_many([key, lock_key])
+            entry = values.get(key)
+            if entry is None and lock_key not in values:
+                # Render failed or its response was not cacheable, render the page here
+                break
+        if entry is not None:
+            return _make_response(entry)
+
+    try:
+        response = render()
+        if hasattr(response, 'render') and callable(response.render):
+            response.render()
+        if _is_response_cacheable(request, response):
+            entry = _make_entry(response)
+            cache.set(key, entry, timeout)
+            cache.set(stale_key, entry, get_timeout())
+        return response
+    finally:
+        if locked:
+            cache.delete(lock_key)
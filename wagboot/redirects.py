@@ -3,6 +3,9 @@
 Redirects in wagboot are done by adding special field to request.
 This special field will be checked by middleware and response
 will be replaced with HttpResponseRedirect.
+
+Pages served with serve_with_redirects() stop rendering as soon as a block requests redirect
+(block raises RedirectRequested), then middleware is only a fallback.
 """
 from __future__ import absolute_import, unicode_literals
 
@@ -13,6 +16,14 @@ from django.http import HttpResponseRedirect
 
 REDIRECT_URL_FIELD = '_wagboot_redirect_url'
 REDIRECT_PERMANENT_FIELD = '_wagboot_redirect_permanent'
+STOP_ON_REDIRECT_FIELD = '_wagboot_stop_on_redirect'
+
+
+class RedirectRequested(Exception):
+    """
+    Raised by a block which requested redirect, to stop rendering of the rest of the page.
+    """
+    pass
 
 
 def extract_redirect_data_from_request(request):
@@ -29,3 +40,28 @@ def mark_request_for_redirect(request, url, permanent):
         return
     setattr(request, REDIRECT_URL_FIELD, url)
     setattr(request, REDIRECT_PERMANENT_FIELD, permanent)
+
+
+def should_stop_on_redirect(request):
+    """
+    Whether rendering of the page can be stopped by RedirectRequested.
+    """
+    return getattr(request, STOP_ON_REDIRECT_FIELD, False)
+
+
+def serve_with_redirects(request, serve):
+    """
+    Returns response of the page, or redirect response if a block requested redirect while rendering it.
+    Response is rendered here (not by the handler) to catch RedirectRequested.
+    :param serve: callable returning response of the page (can be not rendered TemplateResponse)
+    """
+    setattr(request, STOP_ON_REDIRECT_FIELD, True)
+    try:
+        response = serve()
+        if hasattr(response, 'render') and callable(response.render):
+            response.render()
+        return response
+    except RedirectRequested:
+        return extract_redirect_data_from_request(request)
+    finally:
+        setattr(request, STOP_ON_REDIRECT_FIELD, False)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering of StreamField blocks on wagboot pages (see {% wagboot_stream %} template tag).
+
+Html of blocks which render the same for every visitor is cached by the hash of the block value
+and container_class. Blocks declare what their html depends on with `wagboot_depends_on` in their Meta:
+
+    class MyBlock(blocks.StructBlock):
+        class Meta:
+            wagboot_depends_on = DEPENDS_ON_USER
+
+  - DEPENDS_ON_NOTHING: only on the block value, html is cached and shared by all visitors
+  - DEPENDS_ON_USER: on the logged-in user, rendered for every request
+  - DEPENDS_ON_REQUEST: on the request (forms etc.), rendered for every request
+
+Blocks without declaration are cached, except WagbootBlockMixin (forms etc.) and NoFieldsBlock blocks
+(`wagboot_cache = True/False` in Meta opts in or out as well). Struct, list and stream blocks without
+declaration are cached only if all blocks in their value are.
+
+Pages can disable block cache with `block_cache_enabled = False`, cache only blocks which declare
+DEPENDS_ON_NOTHING with `block_cache_declared_only = True` (restricted pages do so)
+and enable concurrent rendering of blocks with `render_blocks_concurrently = True`.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import json
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+from django.utils import translation
+from django.utils.encoding import force_bytes
+from django.utils.safestring import mark_safe
+from wagtail.wagtailcore import blocks
+
+from wagboot.blocks import WagbootBlockMixin, NoFieldsBlock, PREFIX_CONTEXT_VAR, DEPENDS_ON_NOTHING, \
+    gen_block_prefix
+from wagboot.cache import get_cache, get_generations, get_timeout, make_key, GENERATION_IMAGES, GENERATION_PAGES, \
+    GENERATION_SETTINGS
+
+
+def get_website_settings(context):
+    """
+    Returns WebsiteSettings from template context (or for the site of request in the context).
+    """
+    from wagboot.models import WebsiteSettings
+    try:
+        return context['settings']['wagboot']['WebsiteSettings']
+    except (KeyError, TypeError):
+        return WebsiteSettings.for_site(context['request'].site)
+
+
+def is_block_cacheable(block, declared_only=False):
+    """
+    :type block: wagtail.wagtailcore.blocks.Block
+    :param declared_only: cache only blocks which declare that they depend on nothing
+    """
+    depends_on = getattr(block.meta, 'wagboot_depends_on', None)
+    if depends_on is not None:
+        return depends_on == DEPENDS_ON_NOTHING
+    if declared_only:
+        return False
+
+    cacheable = getattr(block.meta, 'wagboot_cache', None)
+    if cacheable is None:
+        return not isinstance(block, (WagbootBlockMixin, NoFieldsBlock))
+    return cacheable
+
+
+def is_value_cacheable(block, value, declared_only=False):
+    """
+    Whether html of the block value can be cached, checks also blocks nested in the value
+    (unless the block declares wagboot_depends_on, which covers its children).
+    :type block: wagtail.wagtailcore.blocks.Block
+    :param declared_only: cache only blocks which declare that they depend on nothing
+    """
+    if not is_block_cacheable(block, declared_only):
+        return False
+    if getattr(block.meta, 'wagboot_depends_on', None) is not None:
+        return True
+    return all(is_value_cacheable(child_block, child_value, declared_only)
+               for child_block, child_value in _iter_nested(block, value))
+
+
+def _iter_nested(block, value):
+    """
+    Yields (block, value) of blocks directly nested in the value of struct, list and stream blocks.
+    """
+    if value is None:
+        return
+    if isinstance(block, blocks.StructBlock):
+        for name, child_block in block.child_blocks.items():
+            yield child_block, value.get(name)
+    elif isinstance(block, blocks.ListBlock):
+        for child_value in value:
+            yield block.child_block, child_value
+    elif isinstance(block, blocks.StreamBlock):
+        for child in value:
+            yield child.block, child.value
+
+
+def _get_block_cache_key(child, container_class, generations):
+    block = child.block
+    signature = json.dumps([
+        '{}.{}'.format(type(block).__module__, type(block).__name__),
+        child.block_type,
+        block.get_prep_value(child.value),
+        container_class,
+    ], sort_keys=True, cls=DjangoJSONEncoder)
+    return make_key('block', hashlib.sha1(force_bytes(signature)).hexdigest(), *generations)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# Marks threads of the pool while they render
+_pool_local = threading.local()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(processes=getattr(settings, 'WAGBOOT_BLOCK_RENDER_THREADS', 4))
+        return _pool
+
+
+def _render_child(child, block_context):
+    return child.render_as_block(context=block_context)
+
+
+def _can_render_in_pool(block, value):
+    """
+    Only blocks without side effects which do not use request (forms change session, messages, database...)
+    are rendered in the pool, other blocks are rendered in the request thread.
+    Blocks nested in the value are checked too (they also get prefixes from the request in the order of render).
+    """
+    depends_on = getattr(block.meta, 'wagboot_depends_on', None)
+    if depends_on not in (None, DEPENDS_ON_NOTHING):
+        return False
+    if isinstance(block, (WagbootBlockMixin, NoFieldsBlock)):
+        return False
+    return all(_can_render_in_pool(child_block, child_value)
+               for child_block, child_value in _iter_nested(block, value))
+
+
+def _render_child_in_pool(child, block_context, language):
+    translation.activate(language)
+    _pool_local.active = True
+    try:
+        return _render_child(child, block_context)
+    finally:
+        _pool_local.active = False
+        translation.deactivate()
+        # Pool threads do not get request_finished signal, which closes connections
+        close_old_connections()
+
+
+def render_stream(stream_value, context, use_cache=True, concurrent=False, declared_only=False):
+    """
+    Renders all blocks of the stream the same way as {% for block in stream %}{% include_block block %}.
+
+    With concurrent=True blocks are rendered in a pool of WAGBOOT_BLOCK_RENDER_THREADS threads (default: 4).
+    Blocks still get the same prefixes as when rendered one by one (only blocks nested in other blocks
+    get them in order of rendering). Blocks rendered in the pool use their own database connections,
+    so they do not see changes made in the current transaction.
+    WagbootBlockMixin, NoFieldsBlock and blocks declaring dependency on user or request are always rendered
+    in the request thread, streams rendered inside the pool (nested {% wagboot_stream %}) are not concurrent.
+
+    :type stream_value: wagtail.wagtailcore.blocks.StreamValue
+    :type context: django.template.Context
+    :param use_cache: whether html of cacheable blocks can be cached
+    :param declared_only: whether only blocks declaring DEPENDS_ON_NOTHING can be cached
+    :param concurrent: whether blocks can be rendered concurrently
+    """
+    parent_context = context.flatten()
+    cache = get_cache()
+    cached_html = {}
+    keys = {}
+    children = list(stream_value)
+
+    if use_cache:
+        container_class = get_website_settings(context).container_class
+        # Html has urls of image renditions, which are deleted when the image file is replaced
+        generations = get_generations(GENERATION_PAGES, GENERATION_SETTINGS, GENERATION_IMAGES)
+        for index, child in enumerate(children):
+            if is_value_cacheable(child.block, child.value, declared_only):
+                keys[index] = _get_block_cache_key(child, container_class, generations)
+        if keys:
+            cached_html = cache.get_many(list(keys.values()))
+
+    rendered = [cached_html.get(keys.get(index)) for index in range(len(children))]
+    to_render = [index for index, html in enumerate(rendered) if html is None]
+    # Pool threads must not wait for the pool (it could run out of threads)
+    concurrent = concurrent and len(to_render) > 1 and not getattr(_pool_local, 'active', False)
+
+    block_contexts = {}
+    for index in to_render:
+        block_context = dict(parent_context)
+        block_context['block'] = children[index]
+        if concurrent and isinstance(children[index].block, WagbootBlockMixin):
+            # Prefixes must not depend on the order in which threads render blocks
+            block_context[PREFIX_CONTEXT_VAR] = gen_block_prefix(context['request'])
+        block_contexts[index] = block_context
+
+    in_pool = []
+    if concurrent:
+        in_pool = [index for index in to_render if _can_render_in_pool(children[index].block, children[index].value)]
+    results = {}
+    if len(in_pool) > 1:
+        language = translation.get_language()
+        pool = _get_pool()
+        results = dict(
+            (index, pool.apply_async(_render_child_in_pool, (children[index], block_contexts[index], language)))
+            for index in in_pool)
+    for index in to_render:
+        if index not in results:
+            rendered[index] = _render_child(children[index], block_contexts[index])
+    for index, result in results.items():
+        rendered[index] = result.get()
+
+    for index in to_render:
+        if index in keys:
+            cache.set(keys[index], rendered[index], get_timeout())
+
+    return mark_safe(''.join(rendered))
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Generation of image renditions before they are requested by page views.
+
+Blocks declare filter specs of images in their value with `wagboot_image_specs` in their Meta:
+
+    class MyBlock(blocks.StructBlock):
+        image = ImageChooserBlock()
+
+        class Meta:
+            wagboot_image_specs = ('width-300', 'width-150')
+
+Images in rich text get the filter spec of their image format.
+
+Renditions of a page are generated in a background thread after the page is published,
+renditions of an image for all wagboot blocks after the image is saved (uploaded).
+Set WAGBOOT_PREGENERATE_RENDITIONS = False to disable it.
+For existing pages and images use wagboot_generate_renditions management command.
+
+Existing renditions of all images of a block can be looked up in one query with prefetch_renditions()
+(see {% wagboot_prefetch_renditions %} template tag).
+"""
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.utils import IntegrityError
+from wagtail.wagtailcore import blocks
+from wagtail.wagtailcore.fields import RichTextField, StreamField
+from wagtail.wagtailcore.rich_text import FIND_EMBED_TAG, extract_attrs
+from wagtail.wagtailimages.blocks import ImageChooserBlock
+from wagtail.wagtailimages.formats import get_image_format
+from wagtail.wagtailimages.models import Filter, get_image_model
+
+logger = logging.getLogger(__name__)
+
+# Filter objects by their spec, shared by all threads
+_filters = {}
+
+
+def get_filter(spec):
+    """
+    Returns Filter for the filter spec, it is looked up in the database only once per process.
+    :rtype: Filter
+    """
+    image_filter = _filters.get(spec)
+    if image_filter is None:
+        image_filter = _filters[spec] = Filter.objects.get_or_create(spec=spec)[0]
+    return image_filter
+
+
+def _iter_rich_text_images(html):
+    for match in FIND_EMBED_TAG.finditer(html or ''):
+        attrs = extract_attrs(match.group(1))
+        if attrs.get('embedtype') != 'image' or not attrs.get('id'):
+            continue
+        try:
+            image_format = get_image_format(attrs.get('format'))
+        except (IndexError, KeyError):
+            # Format was unregistered
+            continue
+        yield int(attrs['id']), image_format.filter_spec
+
+
+def _iter_block_images(block, value, specs=(), objects=False):
+    """
+    Yields (image id, filter spec) of images in the value of the block.
+    :param specs: filter specs of images declared by parent block
+    :param objects: yield images instead of their ids (images in rich text are skipped then)
+    """
+    specs = getattr(block.meta, 'wagboot_image_specs', None) or specs
+    if value is None:
+        return
+    if isinstance(block, ImageChooserBlock):
+        for spec in specs:
+            yield value if objects else value.pk, spec
+    elif isinstance(block, blocks.RichTextBlock):
+        if not objects:
+            for image in _iter_rich_text_images(getattr(value, 'source', value)):
+                yield image
+    elif isinstance(block, blocks.StructBlock):
+        for name, child_block in block.child_blocks.items():
+            for image in _iter_block_images(child_block, value.get(name), specs, objects):
+                yield image
+    elif isinstance(block, blocks.ListBlock):
+        for child_value in value:
+            for image in _iter_block_images(block.child_block, child_value, specs, objects):
+                yield image
+    elif isinstance(block, blocks.StreamBlock):
+        for child in value:
+            for image in _iter_block_images(child.block, child.value, specs, objects):
+                yield image
+
+
+def get_block_images(block, value):
+    """
+    Returns images in the value of the block with filter specs declared by the block.
+    :return: list of (image, filter spec)
+    """
+    return list(_iter_block_images(block, value, objects=True))
+
+
+def prefetch_renditions(image_specs):
+    """
+    Looks up existing renditions of several images in one query (missing renditions are not generated).
+    :param image_specs: iterable of (image, filter spec)
+    :return: {(image id, filter spec): rendition}
+    """
+    images = {}
+    filters = {}
+    for image, spec in image_specs:
+        images[image.pk] = image
+        filters[spec] = get_filter(spec)
+    if not images:
+        return {}
+
+    specs_by_filter_id = dict((image_filter.pk, spec) for spec, image_filter in filters.items())
+    rendition_model = next(iter(images.values())).renditions.model
+    renditions = {}
+    for rendition in rendition_model.objects.filter(image_id__in=list(images),
+                                                    filter_id__in=list(specs_by_filter_id)):
+        image = images[rendition.image_id]
+        spec = specs_by_filter_id[rendition.filter_id]
+        # Renditions made before the focal point change do not match
+        if rendition.focal_point_key == filters[spec].get_cache_key(image):
+            rendition.image = image
+            renditions[(image.pk, spec)] = rendition
+    return renditions
+
+
+def get_page_renditions(page):
+    """
+    Returns filter specs of images used by StreamFields and RichTextFields of the page.
+    :return: set of (image id, filter spec)
+    """
+    page = page.specific
+    renditions = set()
+    for field in page._meta.get_fields():
+        if isinstance(field, StreamField):
+            renditions.update(_iter_block_images(field.stream_block, getattr(page, field.name)))
+        elif isinstance(field, RichTextField):
+            renditions.update(_iter_rich_text_images(getattr(page, field.name)))
+    return renditions
+
+
+def get_block_image_specs():
+    """
+    Returns filter specs declared by wagboot blocks (which new images are likely to be used in).
+    """
+    from wagboot.models import BASE_BLOCKS
+
+    specs = set()
+    for name, block in BASE_BLOCKS:
+        specs.update(getattr(block.meta, 'wagboot_image_specs', None) or ())
+    return specs
+
+
+def generate_renditions(renditions):
+    """
+    Generates missing renditions.
+    :param renditions: iterable of (image id, filter spec)
+    :return: number of renditions which failed
+    """
+    specs_by_image = {}
+    for image_id, spec in renditions:
+        specs_by_image.setdefault(image_id, set()).add(spec)
+
+    errors = 0
+    for image in get_image_model().objects.filter(pk__in=specs_by_image.keys()):
+        for spec in sorted(specs_by_image[image.pk]):
+            try:
+                image.get_rendition(spec)
+            except IntegrityError:
+                # Rendition was created by a page view at the same time
+                pass
+            except Exception:
+                errors += 1
+                logger.exception("Could not generate rendition %s of image %s", spec, image.pk)
+    return errors
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # One thread, so resizing images does not take all CPUs of the web server
+            _pool = ThreadPool(processes=1)
+        return _pool
+
+
+def _run_in_background(func, *args):
+    try:
+        generate_renditions(func(*args))
+    except Exception:
+        logger.exception("Could not generate renditions")
+    finally:
+        close_old_connections()
+
+
+def _get_page_renditions(page_id):
+    from wagtail.wagtailcore.models import Page
+    page = Page.objects.filter(pk=page_id).first()
+    return get_page_renditions(page) if page is not None else ()
+
+
+def _get_image_renditions(image_id):
+    return [(image_id, spec) for spec in get_block_image_specs()]
+
+
+def _schedule(func, *args):
+    if not getattr(settings, 'WAGBOOT_PREGENERATE_RENDITIONS', True):
+        return
+
+    def start():
+        _get_pool().apply_async(_run_in_background, (func,) + args)
+
+    # Background thread must see saved data (transaction.on_commit is not available in Django 1.8)
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is not None:
+        on_commit(start)
+    else:
+        start()
+
+
+def schedule_page_renditions(page):
+    """
+    Generates renditions of images used by the page in the background.
+    """
+    _schedule(_get_page_renditions, page.pk)
+
+
+def schedule_image_renditions(image):
+    """
+    Generates renditions of the image for all wagboot blocks in the background.
+    """
+    _schedule(_get_image_renditions, image.pk)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Index of restricted pages (AbstractRestrictedPage) and login urls of sites, used by RestrictedPageMiddleware
+to redirect anonymous visitors to login without routing the request and loading the page.
+
+Both are kept in process memory: index of pages until any page changes, login urls until settings or pages change
+(checked at most once per WAGBOOT_RESTRICTED_CHECK_INTERVAL seconds, default: 1).
+"""
+from __future__ import absolute_import, unicode_literals
+
+from wagtail.wagtailcore.models import Site, get_page_models
+
+from wagboot.cache import ProcessCache, GENERATION_PAGES, GENERATION_SETTINGS
+from wagboot.routing import get_page_url, iter_page_paths
+
+_restricted_pages = ProcessCache(GENERATION_PAGES, 'WAGBOOT_RESTRICTED_CHECK_INTERVAL')
+_login_urls = ProcessCache((GENERATION_SETTINGS, GENERATION_PAGES), 'WAGBOOT_RESTRICTED_CHECK_INTERVAL')
+
+
+def _build_restricted_pages():
+    """
+    :return: {site_id: {path: page url}}
+    """
+    from wagboot.models import AbstractRestrictedPage
+
+    root_paths = Site.get_site_root_paths()
+    pages = {}
+    for model in get_page_models():
+        if issubclass(model, AbstractRestrictedPage):
+            for url_path in model.objects.filter(live=True).values_list('url_path', flat=True):
+                page_url = get_page_url(url_path, root_paths)
+                for site_id, path in iter_page_paths(url_path, root_paths):
+                    pages.setdefault(site_id, {})[path] = page_url
+    return pages
+
+
+def get_restricted_page_url(site, path):
+    """
+    Returns url of the restricted page if the path is a restricted page on the site, None otherwise.
+    :type site: wagtail.wagtailcore.models.Site
+    :param path: request.path
+    """
+    return _restricted_pages.get('pages', _build_restricted_pages).get(site.pk, {}).get(path)
+
+
+def get_login_url(site):
+    """
+    Returns url of the login page of the site (WebsiteSettings.login_page), None if it is not set.
+    :type site: wagtail.wagtailcore.models.Site
+    """
+    from wagboot.models import WebsiteSettings
+
+    # Empty string marks missing login page (None is not cached)
+    return _login_urls.get(site.pk, lambda: WebsiteSettings.get_login_url(site) or '') or None
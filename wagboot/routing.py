@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Urls of pages computed from their url_path (without loading pages),
+used by routing tables and sitemap built in bulk (see wagboot.aliases, wagboot.restricted and wagboot.sitemap).
+"""
+from __future__ import absolute_import, unicode_literals
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.utils.http import urlunquote
+
+
+def _get_page_path(url_path, root_path):
+    page_path = reverse('wagtail_serve', args=(url_path[len(root_path):],))
+    # Same as Page.get_url_parts
+    if not getattr(settings, 'WAGTAIL_APPEND_SLASH', True) and page_path != '/':
+        page_path = page_path.rstrip('/')
+    return page_path
+
+
+def get_page_url(url_path, root_paths):
+    """
+    Returns url of the page the same way as Page.url.
+    :param root_paths: Site.get_site_root_paths()
+    """
+    for site_id, root_path, root_url in root_paths:
+        if url_path.startswith(root_path):
+            return ('' if len(root_paths) == 1 else root_url) + _get_page_path(url_path, root_path)
+    return None
+
+
+def get_page_full_url(url_path, root_path, root_url):
+    """
+    Returns full url of the page on the site the same way as Page.full_url.
+    :param root_path: url_path of the root page of the site
+    :param root_url: Site.root_url
+    """
+    return root_url + _get_page_path(url_path, root_path)
+
+
+def iter_page_paths(url_path, root_paths):
+    """
+    Yields (site_id, path) for every site the page is served on, path is compared to request.path.
+    :param root_paths: Site.get_site_root_paths()
+    """
+    for site_id, root_path, root_url in root_paths:
+        if url_path.startswith(root_path):
+            yield site_id, urlunquote(_get_page_path(url_path, root_path))
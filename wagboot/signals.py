@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Signal handlers invalidating wagboot caches (see wagboot.cache).
+Connected in WagbootConfig.ready().
+"""
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import time
+
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from wagtail.wagtailcore.models import Page, PageViewRestriction, Site
+from wagtail.wagtailcore.signals import page_published, page_unpublished
+from wagtail.wagtaildocs.models import get_document_model
+from wagtail.wagtailimages.models import get_image_model
+
+from wagboot.cache import bump_generation, get_cache, make_key, GENERATION_IMAGES, GENERATION_MENUS, \
+    GENERATION_PAGES, GENERATION_SETTINGS
+from wagboot.icons import get_site_icons
+from wagboot.models import Css, Menu, MenuItem, WebsiteSettings, clear_settings_cache
+from wagboot.renditions import schedule_image_renditions, schedule_page_renditions
+
+logger = logging.getLogger(__name__)
+
+
+# Fields saved by Page.save_revision() when a draft is saved, they do not change published pages
+REVISION_FIELDS = frozenset(['latest_revision_created_at', 'has_unpublished_changes'])
+
+
+@receiver(post_save)
+def invalidate_on_page_save(sender, instance, created=False, update_fields=None, **kwargs):
+    # Page.move() saves the moved page with all fields, drafts are saved with revision fields only
+    if not isinstance(instance, Page):
+        return
+    if update_fields and REVISION_FIELDS.issuperset(update_fields):
+        return
+    if created and not instance.live:
+        # New draft, page_published follows when it is published
+        return
+    invalidate_on_page_change(sender, instance)
+
+
+@receiver(post_delete)
+def invalidate_on_page_change(sender, instance, **kwargs):
+    if isinstance(instance, Page):
+        bump_generation(GENERATION_PAGES)
+        invalidate_menus(sender, instance)
+
+
+@receiver(page_published)
+@receiver(page_unpublished)
+def invalidate_on_publishing(sender, instance, **kwargs):
+    bump_generation(GENERATION_PAGES)
+    invalidate_menus(sender, instance)
+
+
+@receiver(post_save, sender=Menu)
+@receiver(post_delete, sender=Menu)
+@receiver(post_save, sender=MenuItem)
+@receiver(post_delete, sender=MenuItem)
+@receiver(post_save, sender=get_document_model())
+@receiver(post_delete, sender=get_document_model())
+def invalidate_menus(sender, instance, **kwargs):
+    # Menu snapshots keep resolved urls and titles of linked pages and documents
+    bump_generation(GENERATION_MENUS)
+
+
+@receiver(post_save, sender=WebsiteSettings)
+@receiver(post_delete, sender=WebsiteSettings)
+@receiver(post_save, sender=Css)
+@receiver(post_delete, sender=Css)
+def invalidate_settings(sender, instance, **kwargs):
+    # Settings are kept in memory together with stylesheet and logos
+    clear_settings_cache()
+    bump_generation(GENERATION_SETTINGS)
+
+
+@receiver(post_save, sender=get_image_model())
+@receiver(post_delete, sender=get_image_model())
+def invalidate_images(sender, instance, **kwargs):
+    # Cached blocks and pages have urls of renditions, Wagtail deletes them when the image file is replaced
+    bump_generation(GENERATION_IMAGES)
+
+
+@receiver(post_save, sender=get_image_model())
+@receiver(pre_delete, sender=get_image_model())
+def invalidate_settings_on_logo_change(sender, instance, **kwargs):
+    # Before delete, because logos of settings are set to NULL (without signals) before post_delete
+    if WebsiteSettings.objects.filter(Q(menu_logo_id=instance.pk) | Q(square_logo_id=instance.pk)).exists():
+        invalidate_settings(sender, instance)
+
+
+@receiver(post_save, sender=WebsiteSettings)
+def remember_settings_save_time(sender, instance, **kwargs):
+    # Used as Last-Modified of robots.txt
+    get_cache().set(make_key(GENERATION_SETTINGS, 'saved_at', instance.site_id), time.time(), None)
+
+
+@receiver(post_save, sender=WebsiteSettings)
+def generate_site_icons(sender, instance, **kwargs):
+    # Generate renditions now, instead of during the first page view
+    try:
+        get_site_icons(instance.site)
+    except Exception:
+        logger.exception("Could not generate website icons, they will be generated on page view")
+
+
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+def invalidate_on_site_change(sender, instance, **kwargs):
+    # Page urls depend on sites
+    bump_generation(GENERATION_PAGES)
+    invalidate_menus(sender, instance)
+    invalidate_settings(sender, instance)
+
+
+@receiver(post_save, sender=PageViewRestriction)
+@receiver(post_delete, sender=PageViewRestriction)
+def invalidate_on_view_restriction_change(sender, instance, **kwargs):
+    # Restricted pages are not shown in sitemap
+    bump_generation(GENERATION_PAGES)
+
+
+@receiver(page_published)
+def generate_page_renditions(sender, instance, **kwargs):
+    # Generate renditions now, instead of during the first page view
+    schedule_page_renditions(instance)
+
+
+@receiver(post_save, sender=get_image_model())
+def generate_image_renditions(sender, instance, **kwargs):
+    schedule_image_renditions(instance)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+sitemap.xml of wagboot pages (live AbstractGenericPage pages with show_in_sitemap set).
+
+Pages are fetched in bulk with values_list() (one query per generic page model, no page instances),
+urls are split into sections of WAGBOOT_SITEMAP_SECTION_SIZE urls (default: 10000),
+which are listed in the sitemap index. Gzipped sections are cached per site until any page changes.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import gzip
+import io
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.utils.encoding import force_bytes
+from wagtail.wagtailcore.models import PageViewRestriction, get_page_models
+
+from wagboot.cache import get_cache, get_generation, get_timeout, make_key, GENERATION_PAGES
+from wagboot.routing import get_page_full_url
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+XMLNS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+
+def get_section_size():
+    return getattr(settings, 'WAGBOOT_SITEMAP_SECTION_SIZE', 10000)
+
+
+def iter_sitemap_urls(site):
+    """
+    Yields (location, lastmod) of pages of the site shown in sitemap, ordered by their place in the tree.
+    Pages with view restrictions (and their descendants) are not shown.
+    :type site: wagtail.wagtailcore.models.Site
+    """
+    from wagboot.models import AbstractGenericPage
+
+    root_page = site.root_page
+    restricted_paths = tuple(PageViewRestriction.objects.filter(page__path__startswith=root_page.path)
+                             .values_list('page__path', flat=True))
+    pages = []
+    for model in get_page_models():
+        if issubclass(model, AbstractGenericPage):
+            pages.extend(model.objects.filter(live=True, show_in_sitemap=True, path__startswith=root_page.path)
+                         .values_list('path', 'url_path', 'latest_revision_created_at'))
+    pages.sort()
+
+    root_url = site.root_url
+    for path, url_path, lastmod in pages:
+        if restricted_paths and path.startswith(restricted_paths):
+            continue
+        yield get_page_full_url(url_path, root_page.url_path, root_url), lastmod
+
+
+def _write_section(urls):
+    """
+    :return: (gzipped xml, latest lastmod of the urls)
+    """
+    output = io.BytesIO()
+    latest = None
+    # mtime=0 makes content the same for the same urls
+    with gzip.GzipFile(fileobj=output, mode='wb', mtime=0) as xml:
+        xml.write(force_bytes('{}<urlset xmlns="{}">\n'.format(XML_HEADER, XMLNS)))
+        for location, lastmod in urls:
+            entry = '<url><loc>{}</loc>'.format(escape(location))
+            if lastmod:
+                entry += '<lastmod>{}</lastmod>'.format(lastmod.date().isoformat())
+                latest = max(latest, lastmod) if latest else lastmod
+            xml.write(force_bytes(entry + '</url>\n'))
+        xml.write(b'</urlset>\n')
+    return output.getvalue(), latest
+
+
+def _build_sitemap(site, key):
+    """
+    Writes all sections of the site to the cache.
+    :return: (list of lastmod of sections, list of gzipped sections)
+    """
+    cache = get_cache()
+    section_size = get_section_size()
+    urls = list(iter_sitemap_urls(site))
+    sections, contents = [], []
+    for start in range(0, max(len(urls), 1), section_size):
+        content, lastmod = _write_section(urls[start:start + section_size])
+        sections.append(lastmod)
+        contents.append(content)
+        cache.set(make_key(key, 'section', len(sections)), content, get_timeout())
+    cache.set(key, sections, get_timeout())
+    return sections, contents
+
+
+def _get_key(site):
+    return make_key('sitemap', site.pk, get_generation(GENERATION_PAGES))
+
+
+def get_sitemap_index(site):
+    """
+    :return: xml of the sitemap index
+    """
+    key = _get_key(site)
+    sections = get_cache().get(key)
+    if sections is None:
+        sections = _build_sitemap(site, key)[0]
+
+    lines = [XML_HEADER, '<sitemapindex xmlns="{}">\n'.format(XMLNS)]
+    for number, lastmod in enumerate(sections, 1):
+        lines.append('<sitemap><loc>{}{}</loc>'.format(
+            site.root_url, escape(reverse('sitemap_section', kwargs={'section': number}))))
+        if lastmod:
+            lines.append('<lastmod>{}</lastmod>'.format(lastmod.isoformat()))
+        lines.append('</sitemap>\n')
+    lines.append('</sitemapindex>\n')
+    return ''.join(lines)
+
+
+def get_sitemap_section(site, number):
+    """
+    :param number: number of the section, starting from 1
+    :return: gzipped xml of the section, None if there is no such section
+    """
+    key = _get_key(site)
+    cache = get_cache()
+    content = cache.get(make_key(key, 'section', number))
+    if content is None:
+        sections = cache.get(key)
+        if sections is not None and number > len(sections):
+            return None
+        # Section was evicted (or sitemap was never built)
+        sections, contents = _build_sitemap(site, key)
+        if number > len(contents):
+            return None
+        content = contents[number - 1]
+    return content
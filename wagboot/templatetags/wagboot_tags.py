@@ -1,11 +1,29 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
+import re
+
 from django import template
+from django.utils.encoding import force_text
+from django.utils.safestring import mark_safe
+from wagtail.wagtailimages.models import SourceImageIOError
 from wagtail.wagtailimages.templatetags.wagtailimages_tags import ImageNode
 
+from wagboot.cache import get_cache, get_generations, get_timeout, make_key, GENERATION_MENUS, GENERATION_SETTINGS
+from wagboot.icons import get_site_icons
+from wagboot.rendering import get_website_settings, render_stream
+from wagboot.renditions import get_block_images, get_filter, prefetch_renditions
+
 register = template.Library()
 
+MENU_ITEM_MARKER_RE = re.compile(r' data-wagboot-menu-item="(\d+)"')
+
+# Rendered instead of CSRF token in cached forms
+CSRF_TOKEN_PLACEHOLDER = 'wagbootcsrftokenplaceholder'
+
+# Context variable with renditions looked up by {% wagboot_prefetch_renditions %}
+RENDITIONS_CONTEXT_VAR = 'wagboot_renditions'
+
 
 @register.filter()
 def add_class_to_field(bound_field, klass):
@@ -29,9 +47,153 @@ def image(parser, token):
 
 
 class ImageNodeWithVariables(ImageNode):
+    """
+    Node is shared by all renders of the template, so filter spec resolved for the render is not saved on it.
+    Uses renditions from {% wagboot_prefetch_renditions %} if there are any.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ImageNodeWithVariables, self).__init__(*args, **kwargs)
+        self.filter_spec_variable = template.Variable(self.filter_spec)
+
+    def get_filter_spec(self, context):
+        try:
+            return self.filter_spec_variable.resolve(context) or "original"
+        except template.VariableDoesNotExist:
+            return self.filter_spec
+
     def render(self, context):
         try:
-            self.filter_spec = template.Variable(self.filter_spec).resolve(context) or "original"
+            image = self.image_expr.resolve(context)
         except template.VariableDoesNotExist:
-            pass
-        return super(ImageNodeWithVariables, self).render(context)
+            return ''
+        if not image:
+            return ''
+
+        filter_spec = self.get_filter_spec(context)
+        rendition = (context.get(RENDITIONS_CONTEXT_VAR) or {}).get((image.pk, filter_spec))
+        if rendition is None:
+            try:
+                rendition = image.get_rendition(get_filter(filter_spec))
+            except SourceImageIOError:
+                # Image file is missing, same as {% image %} tag
+                rendition = image.renditions.model(image=image, width=0, height=0)
+                rendition.file.name = 'not-found'
+
+        if self.output_var_name:
+            context[self.output_var_name] = rendition
+            return ''
+        return rendition.img_tag(dict((key, value.resolve(context)) for key, value in self.attrs.items()))
+
+
+def _render_menu(context, template_name, menu):
+    """
+    Renders menu template, rendered html is cached per (menu, site, container_class).
+
+    Template is rendered with `menu_item_markers` in the context, so it marks items with
+    data-wagboot-menu-item="<index>" instead of checking request.path. Markers are replaced with
+    the "active" class (or removed) for every request.
+    Html of templates which do not mark items (e.g. overridden templates checking request.path)
+    is not cached, they are rendered for every request.
+    """
+    request = context['request']
+    container_class = get_website_settings(context).container_class
+
+    cache = get_cache()
+    key = make_key(GENERATION_MENUS, 'fragment', template_name, getattr(menu, 'pk', None), request.site.pk,
+                   container_class, *get_generations(GENERATION_MENUS, GENERATION_SETTINGS))
+    fragment = cache.get(key)
+    if fragment is None:
+        hrefs = tuple(item.href for item in menu.get_snapshot().items) if menu else ()
+        with context.push(menu=menu, menu_item_markers=True):
+            html = context.template.engine.get_template(template_name).render(context)
+        if not MENU_ITEM_MARKER_RE.search(html):
+            # Html may depend on the request, it is rendered for this request only
+            cache.set(key, (None, hrefs), get_timeout())
+            return mark_safe(html)
+        fragment = (html, hrefs)
+        cache.set(key, fragment, get_timeout())
+
+    html, hrefs = fragment
+    if html is None:
+        with context.push(menu=menu):
+            return mark_safe(context.template.engine.get_template(template_name).render(context))
+
+    def replace_marker(match):
+        index = int(match.group(1))
+        if index < len(hrefs) and hrefs[index] == request.path:
+            return ' class="active"'
+        return ''
+
+    return mark_safe(MENU_ITEM_MARKER_RE.sub(replace_marker, html))
+
+
+@register.simple_tag(takes_context=True)
+def wagboot_top_menu(context, menu, template_name="wagboot/menu/_top.html"):
+    return _render_menu(context, template_name, menu)
+
+
+@register.simple_tag(takes_context=True)
+def wagboot_bottom_menu(context, menu, template_name="wagboot/menu/_bottom.html"):
+    return _render_menu(context, template_name, menu)
+
+
+@register.simple_tag(takes_context=True)
+def wagboot_prefetch_renditions(context, bound_block):
+    """
+    Looks up renditions of all images of the block (with filter specs from wagboot_image_specs of the block)
+    in one query, {% image_with_variables %} tags in the rest of the template use them.
+    Usage: {% wagboot_prefetch_renditions block %}
+    Does nothing if the block is not available (e.g. template is rendered only with value).
+    """
+    if not hasattr(bound_block, 'block') or not hasattr(bound_block, 'value'):
+        return ''
+    renditions = dict(context.get(RENDITIONS_CONTEXT_VAR) or {})
+    renditions.update(prefetch_renditions(get_block_images(bound_block.block, bound_block.value)))
+    context[RENDITIONS_CONTEXT_VAR] = renditions
+    return ''
+
+
+@register.simple_tag(takes_context=True)
+def wagboot_site_icons(context):
+    """
+    Renders favicon and touch icons <link> tags made of WebsiteSettings.square_logo.
+    """
+    return get_site_icons(context['request'].site)
+
+
+@register.simple_tag(takes_context=True)
+def wagboot_stream(context, stream_value):
+    """
+    Renders all blocks of StreamField, html of content blocks is cached (see wagboot.rendering).
+    """
+    page = context.get('page')
+    return render_stream(stream_value, context,
+                         use_cache=getattr(page, 'block_cache_enabled', True),
+                         declared_only=getattr(page, 'block_cache_declared_only', False),
+                         concurrent=getattr(page, 'render_blocks_concurrently', False))
+
+
+@register.simple_tag(takes_context=True)
+def wagboot_crispy(context, form):
+    """
+    Renders form the same way as {% crispy form %}.
+
+    Html of unbound forms of form blocks is cached (see FormBlockMixin.get_form_render_cache_key)
+    with a placeholder instead of CSRF token, which is replaced by the token of the request.
+    """
+    from crispy_forms.utils import render_crispy_form
+
+    key = getattr(form, 'wagboot_render_cache_key', None)
+    csrf_token = context.get('csrf_token')
+    if not key or not csrf_token or csrf_token == 'NOTPROVIDED':
+        return render_crispy_form(form, context=context.flatten())
+
+    cache = get_cache()
+    html = cache.get(key)
+    if html is None:
+        form_context = context.flatten()
+        form_context['csrf_token'] = CSRF_TOKEN_PLACEHOLDER
+        html = render_crispy_form(form, context=form_context)
+        cache.set(key, html, get_timeout())
+    return mark_safe(html.replace(CSRF_TOKEN_PLACEHOLDER, force_text(csrf_token)))
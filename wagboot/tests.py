@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of wagboot, run them in a Wagtail project which has wagboot installed:
+
+    ./manage.py test wagboot
+"""
+from __future__ import absolute_import, unicode_literals
+
+import six
+import threading
+import time
+
+from django import forms
+from django.conf.urls import include, url
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.template import engines
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils.encoding import force_bytes, force_text
+from django.utils.http import urlsafe_base64_encode
+from wagtail.wagtailcore import blocks
+from wagtail.wagtailcore import urls as wagtail_urls
+from wagtail.wagtailcore.models import Site
+
+from wagboot import models as wagboot_models
+from wagboot import page_cache
+from wagboot import rendering
+from wagboot.blocks import FormWithLegendBlock, LoginBlock, PasswordResetBlock, DEPENDS_ON_USER, _render_local
+from wagboot.menus import MenuItemSnapshot, MenuSnapshot
+from wagboot.models import BaseGenericPage, Css, WebsiteSettings
+from wagboot.redirects import REDIRECT_URL_FIELD
+from wagboot.routing import get_page_full_url
+
+
+class NameForm(forms.Form):
+    name = forms.CharField()
+
+
+class NameFormBlock(FormWithLegendBlock):
+    """
+    Form block which checks that the state of its render is not changed by renders in other threads.
+    """
+    form_class = NameForm
+
+    def __init__(self, *args, **kwargs):
+        super(NameFormBlock, self).__init__(*args, **kwargs)
+        self.leaks = []
+
+    def get_success_url(self):
+        return '/done/{}/'.format(self.request.POST['{}-name'.format(self.prefix)])
+
+    def pre_render_action(self):
+        state = (self.request, self.prefix, self.block_value)
+        context = super(NameFormBlock, self).pre_render_action()
+        # Other threads render the same block meanwhile
+        time.sleep(0.001)
+        if any(before is not after for before, after in zip(state, (self.request, self.prefix, self.block_value))):
+            self.leaks.append(state)
+        return context
+
+
+class ConcurrentFormRenderTest(SimpleTestCase):
+    threads = 8
+    renders_per_thread = 25
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.block = NameFormBlock()
+
+    def _render_page(self, number):
+        """
+        Renders two form blocks of one page, the form of one of them is posted.
+        :return: (posted prefix, request, [(prefix, html)])
+        """
+        posted_prefix = 'block-{}'.format(1 + number % 2)
+        request = self.factory.post('/', {'{}-name'.format(posted_prefix): 'name-{}'.format(number)})
+        value = self.block.to_python({'legend': 'Legend {}'.format(number)})
+        rendered = []
+        for index in range(2):
+            html = self.block.render(value, context={'request': request})
+            rendered.append(('block-{}'.format(index + 1), html))
+        return posted_prefix, request, rendered
+
+    def _check_page(self, number, errors):
+        posted_prefix, request, rendered = self._render_page(number)
+        name = 'name-{}'.format(number)
+        for prefix, html in rendered:
+            if 'name="{}-name"'.format(prefix) not in html:
+                errors.append("{}: form of {} is not rendered with its prefix".format(number, prefix))
+            if prefix == posted_prefix and 'value="{}"'.format(name) not in html:
+                errors.append("{}: posted data is missing in {}".format(number, prefix))
+            if prefix != posted_prefix and 'value="name-' in html:
+                errors.append("{}: {} got data posted to another form".format(number, prefix))
+        if getattr(request, REDIRECT_URL_FIELD, None) != '/done/{}/'.format(name):
+            errors.append("{}: redirect of another request".format(number))
+        if getattr(_render_local, 'states', None):
+            errors.append("{}: render state was not dropped".format(number))
+
+    def test_concurrent_renders_do_not_share_state(self):
+        errors = []
+
+        def run(thread_number):
+            try:
+                for render_number in range(self.renders_per_thread):
+                    self._check_page(thread_number * self.renders_per_thread + render_number, errors)
+            except Exception as e:
+                errors.append(repr(e))
+
+        threads = [threading.Thread(target=run, args=(number,)) for number in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.block.leaks, [])
+
+
+class PasswordResetQueriesTest(TestCase):
+
+    def setUp(self):
+        self.site = Site.objects.get(is_default_site=True)
+        WebsiteSettings.objects.update_or_create(site=self.site, defaults={'from_email': 'noreply@example.com'})
+        # Settings are kept in memory, so renders do not query them
+        WebsiteSettings.for_site(self.site)
+
+        self.user = get_user_model().objects.create_user('reset', 'reset@example.com', 'secret')
+        self.block = PasswordResetBlock()
+        self.value = self.block.to_python({'reset_email_subject': 'Password reset', 'reset_email_text': 'Reset'})
+
+    def _render(self, data):
+        request = RequestFactory().get('/reset/', data)
+        request.site = self.site
+        return self.block.render(self.value, context={'request': request})
+
+    def test_user_is_looked_up_once_per_render(self):
+        data = {
+            'reset_uid': force_text(urlsafe_base64_encode(force_bytes(self.user.pk))),
+            'reset_token': PasswordResetBlock.token_generator.make_token(self.user),
+        }
+        # Link is checked by get_form_class, get_form_kwargs, get_initial, get_submit_text and get_context
+        for render in range(2):
+            with self.assertNumQueries(1):
+                html = self._render(data)
+            self.assertIn('Change Password', html)
+
+    def test_user_is_not_looked_up_without_link(self):
+        with self.assertNumQueries(0):
+            html = self._render({})
+        self.assertIn('Reset Password', html)
+
+
+class GreetingBlock(blocks.StructBlock):
+    """
+    Greets the logged-in user.
+    """
+    text = blocks.CharBlock()
+
+    class Meta:
+        wagboot_depends_on = DEPENDS_ON_USER
+
+
+class TitleBlock(blocks.StructBlock):
+    title = blocks.CharBlock()
+
+
+class SectionBlock(blocks.StructBlock):
+    title = blocks.CharBlock()
+    greeting = GreetingBlock()
+
+
+BODY_BLOCK = blocks.StreamBlock([
+    ('title', TitleBlock()),
+    ('greeting', GreetingBlock()),
+    ('section', SectionBlock()),
+])
+
+
+class PageStub(object):
+    """
+    Has the serving logic of BaseGenericPage without being a page model.
+    """
+    page_cache_timeout = None
+    block_cache_declared_only = False
+
+    serve = six.get_unbound_function(BaseGenericPage.serve)
+    is_page_cacheable = six.get_unbound_function(BaseGenericPage.is_page_cacheable)
+
+    def __init__(self, *children):
+        self.body = BODY_BLOCK.to_python([{'type': block_type, 'value': value} for block_type, value in children])
+
+
+@override_settings(WAGBOOT_PAGE_CACHE_TIMEOUT=60)
+class PageCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self._patch(page_cache, 'serve_cached', lambda request, render, timeout: 'cached')
+        self._patch(wagboot_models, 'serve_with_redirects', lambda request, serve: 'not cached')
+
+        self.request = RequestFactory().get('/')
+        self.request.user = AnonymousUser()
+
+    def _patch(self, module, name, value):
+        self.addCleanup(setattr, module, name, getattr(module, name))
+        setattr(module, name, value)
+
+    def test_page_with_content_blocks_is_cached(self):
+        page = PageStub(('title', {'title': 'Welcome'}))
+        self.assertTrue(page.is_page_cacheable())
+        self.assertEqual(page.serve(self.request), 'cached')
+
+    def test_page_with_user_dependent_block_is_not_cached(self):
+        page = PageStub(('title', {'title': 'Welcome'}), ('greeting', {'text': 'Hello'}))
+        self.assertFalse(page.is_page_cacheable())
+        self.assertEqual(page.serve(self.request), 'not cached')
+
+    def test_page_with_nested_user_dependent_block_is_not_cached(self):
+        page = PageStub(('section', {'title': 'Welcome', 'greeting': {'text': 'Hello'}}))
+        self.assertFalse(page.is_page_cacheable())
+        self.assertEqual(page.serve(self.request), 'not cached')
+
+
+@override_settings(ROOT_URLCONF='wagboot.urls')
+class CssUrlTest(SimpleTestCase):
+
+    def setUp(self):
+        # Not saved, so css is not compiled and written
+        self.css = Css(name='Default', css='body { color: red; }', _compiled_css='body{color:red}',
+                       _compiled_css_file='0123abcd.css')
+
+    def test_compiled_file_url(self):
+        self.assertEqual(self.css.get_css_url(), '/wagboot/css/0123abcd.css')
+
+    @override_settings(WAGBOOT_INLINE_CSS=True)
+    def test_inlined_css_has_no_url(self):
+        self.assertIsNone(self.css.get_css_url())
+
+    def test_css_without_file_has_no_url(self):
+        self.css._compiled_css_file = None
+        self.assertIsNone(self.css.get_css_url())
+
+
+class LoginSectionBlock(blocks.StructBlock):
+    title = blocks.CharBlock()
+    login = LoginBlock()
+
+
+class RenderInPoolTest(SimpleTestCase):
+
+    def test_content_block_is_rendered_in_pool(self):
+        block = TitleBlock()
+        self.assertTrue(rendering._can_render_in_pool(block, block.to_python({'title': 'Welcome'})))
+
+    def test_nested_user_dependent_block_is_rendered_in_request_thread(self):
+        block = SectionBlock()
+        value = block.to_python({'title': 'Welcome', 'greeting': {'text': 'Hello'}})
+        self.assertFalse(rendering._can_render_in_pool(block, value))
+
+    def test_form_block_nested_in_struct_is_rendered_in_request_thread(self):
+        block = LoginSectionBlock()
+        value = block.to_python({'title': 'Sign in', 'login': {'legend': 'Welcome back'}})
+        self.assertFalse(rendering._can_render_in_pool(block, value))
+
+    def test_form_block_nested_in_list_is_rendered_in_request_thread(self):
+        block = blocks.ListBlock(LoginSectionBlock())
+        value = block.to_python([{'title': 'Sign in', 'login': {'legend': 'Welcome back'}}])
+        self.assertFalse(rendering._can_render_in_pool(block, value))
+
+
+# Wagtail is not mounted at / (used by PageUrlTest)
+urlpatterns = [
+    url(r'^pages/', include(wagtail_urls)),
+]
+
+
+@override_settings(ROOT_URLCONF='wagboot.tests')
+class PageUrlTest(SimpleTestCase):
+
+    def test_full_url_follows_wagtail_mount_point(self):
+        self.assertEqual(get_page_full_url('/home/about/team/', '/home/', 'http://example.com'),
+                         'http://example.com/pages/about/team/')
+        self.assertEqual(get_page_full_url('/home/', '/home/', 'http://example.com'),
+                         'http://example.com/pages/')
+
+    @override_settings(WAGTAIL_APPEND_SLASH=False)
+    def test_full_url_without_trailing_slash(self):
+        self.assertEqual(get_page_full_url('/home/about/team/', '/home/', 'http://example.com'),
+                         'http://example.com/pages/about/team')
+
+
+class CachedNameFormBlock(NameFormBlock):
+    cache_unbound_form = True
+
+
+class FormRenderCacheKeyTest(SimpleTestCase):
+
+    def _get_key(self, block, change_form=None):
+        block._push_render_state()
+        try:
+            block.prefix = 'block-1'
+            form = NameForm(prefix=block.prefix)
+            if change_form:
+                change_form(form)
+            return block.get_form_render_cache_key(form)
+        finally:
+            block._pop_render_state()
+
+    def test_forms_are_not_cached_without_opt_in(self):
+        self.assertIsNone(self._get_key(NameFormBlock()))
+        self.assertIsNotNone(self._get_key(CachedNameFormBlock()))
+
+    def test_key_follows_definition_of_fields(self):
+        block = CachedNameFormBlock()
+        key = self._get_key(block)
+        self.assertEqual(self._get_key(block), key)
+
+        def change_label(form):
+            form.fields['name'].label = 'Full name'
+
+        def add_field(form):
+            form.fields['email'] = forms.EmailField()
+
+        self.assertNotEqual(self._get_key(block, change_label), key)
+        self.assertNotEqual(self._get_key(block, add_field), key)
+
+    def test_key_follows_template_pack(self):
+        block = CachedNameFormBlock()
+        with override_settings(CRISPY_TEMPLATE_PACK='bootstrap'):
+            key = self._get_key(block)
+        with override_settings(CRISPY_TEMPLATE_PACK='bootstrap3'):
+            self.assertNotEqual(self._get_key(block), key)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   WAGBOOT_CACHE='default', WAGBOOT_PAGE_CACHE_LOCK_TIMEOUT=5)
+class ServeCachedTest(SimpleTestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def _get(self):
+        request = self.factory.get('/cached/')
+        request.site = Site(pk=1)
+        return request
+
+    def test_cached_response_keeps_headers(self):
+        def render():
+            response = HttpResponse('Page', content_type='text/html; charset=utf-8')
+            response['Cache-Control'] = 'max-age=60'
+            response['Vary'] = 'Accept-Language'
+            response['X-Page'] = 'cached'
+            return response
+
+        def render_again():
+            raise AssertionError("Page should be served from the cache")
+
+        page_cache.serve_cached(self._get(), render, 60)
+        response = page_cache.serve_cached(self._get(), render_again, 60)
+        self.assertEqual(response.content, b'Page')
+        self.assertEqual(response['Content-Type'], 'text/html; charset=utf-8')
+        self.assertEqual(response['Cache-Control'], 'max-age=60')
+        self.assertEqual(response['Vary'], 'Accept-Language')
+        self.assertEqual(response['X-Page'], 'cached')
+
+    def test_waiting_stops_when_render_is_not_cached(self):
+        rendering_started = threading.Event()
+
+        def render_uncacheable():
+            rendering_started.set()
+            time.sleep(0.2)
+            return HttpResponse('Error', status=500)
+
+        first = threading.Thread(target=page_cache.serve_cached, args=(self._get(), render_uncacheable, 60))
+        first.start()
+        rendering_started.wait()
+        started_at = time.time()
+        response = page_cache.serve_cached(self._get(), lambda: HttpResponse('Page'), 60)
+        first.join()
+
+        self.assertEqual(response.content, b'Page')
+        # Not the lock timeout
+        self.assertLess(time.time() - started_at, 2)
+
+
+MENU_ITEMS = '{% for item in menu.get_snapshot.items %}<li{{ marker }}>{{ item.label }}</li>{% endfor %}'
+MENU_TEMPLATES = {
+    'page.html': '{% load wagboot_tags %}{% wagboot_top_menu menu template_name %}',
+    # Template of a project made before menu_item_markers
+    'old_menu.html': MENU_ITEMS.replace(
+        '{{ marker }}', '{% if item.href == request.path %} class="active"{% endif %}'),
+    'marked_menu.html': MENU_ITEMS.replace(
+        '{{ marker }}', '{% if menu_item_markers %} data-wagboot-menu-item="{{ forloop.counter0 }}"'
+                        '{% elif item.href == request.path %} class="active"{% endif %}'),
+}
+
+
+class MenuStub(object):
+    pk = 1
+
+    def get_snapshot(self):
+        return MenuSnapshot(self.pk, 'Main', (MenuItemSnapshot('/a/', 'A'), MenuItemSnapshot('/b/', 'B')))
+
+
+class WebsiteSettingsStub(object):
+    container_class = 'container'
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   WAGBOOT_CACHE='default',
+                   TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                               'OPTIONS': {'loaders': [('django.template.loaders.locmem.Loader', MENU_TEMPLATES)]}}])
+class MenuRenderTest(SimpleTestCase):
+
+    def _render(self, template_name, path):
+        request = RequestFactory().get(path)
+        request.site = Site(pk=1)
+        context = {
+            'request': request,
+            'menu': MenuStub(),
+            'template_name': template_name,
+            'settings': {'wagboot': {'WebsiteSettings': WebsiteSettingsStub()}},
+        }
+        return engines['django'].get_template('page.html').render(context)
+
+    def test_marked_items_are_activated_per_request(self):
+        self.assertEqual(self._render('marked_menu.html', '/a/'), '<li class="active">A</li><li>B</li>')
+        self.assertEqual(self._render('marked_menu.html', '/b/'), '<li>A</li><li class="active">B</li>')
+
+    def test_template_without_markers_is_rendered_per_request(self):
+        self.assertEqual(self._render('old_menu.html', '/a/'), '<li class="active">A</li><li>B</li>')
+        self.assertEqual(self._render('old_menu.html', '/b/'), '<li>A</li><li class="active">B</li>')
@@ -3,9 +3,12 @@ from __future__ import absolute_import, unicode_literals
 
 from django.conf.urls import url
 
-from wagboot.views import robots_txt, redirect_to_login
+from wagboot.views import robots_txt, redirect_to_login, compiled_css, sitemap_index, sitemap_section
 
 urlpatterns = [
     url(r'^robots.txt', robots_txt, name='robots_txt'),
     url(r'^redirect-to-login', redirect_to_login, name='redirect_to_login'),
+    url(r'^sitemap\.xml$', sitemap_index, name='sitemap_index'),
+    url(r'^sitemap-(?P<section>[0-9]+)\.xml$', sitemap_section, name='sitemap_section'),
+    url(r'^wagboot/css/(?P<file_name>[0-9a-f]+\.css)$', compiled_css, name='compiled_css'),
 ]
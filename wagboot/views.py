@@ -1,15 +1,55 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
-from django.http import HttpResponse, HttpResponseRedirect
+import datetime
+import gzip
+import hashlib
+import io
+import time
 
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.encoding import force_bytes
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+
+from wagboot.cache import get_cache, get_generation, get_timeout, make_key, GENERATION_SETTINGS
+from wagboot.css import CSS_FILE_NAME_RE, get_css_path
 from wagboot.models import WebsiteSettings
+from wagboot.restricted import get_login_url
+from wagboot.sitemap import get_sitemap_index, get_sitemap_section
 
 
-def robots_txt(request):
-    website_settings = WebsiteSettings.for_site(request.site)
+def _get_robots_txt(request):
+    """
+    Returns (content, etag, last_modified) of robots.txt for the site of the request.
+    Cached per site until WebsiteSettings change, last_modified is the time of the last settings save.
+    """
+    robots = getattr(request, '_wagboot_robots_txt', None)
+    if robots is None:
+        cache = get_cache()
+        key = make_key(GENERATION_SETTINGS, get_generation(GENERATION_SETTINGS), 'robots_txt', request.site.pk)
+        robots = cache.get(key)
+        if robots is None:
+            content = WebsiteSettings.get_attr_for_site('robots_txt', request.site) or "Allow /\n"
+            saved_at = cache.get(make_key(GENERATION_SETTINGS, 'saved_at', request.site.pk)) or time.time()
+            robots = (content,
+                      hashlib.sha1(force_bytes(content)).hexdigest(),
+                      datetime.datetime.fromtimestamp(int(saved_at), timezone.utc))
+            cache.set(key, robots, get_timeout())
+        request._wagboot_robots_txt = robots
+    return robots
+
 
-    return HttpResponse(content=website_settings.robots_txt or "Allow /\n", content_type="text/plain")
+@cache_control(public=True, max_age=getattr(settings, 'WAGBOOT_ROBOTS_TXT_MAX_AGE', 60 * 60))
+@condition(etag_func=lambda request: _get_robots_txt(request)[1],
+           last_modified_func=lambda request: _get_robots_txt(request)[2])
+def robots_txt(request):
+    content, etag, last_modified = _get_robots_txt(request)
+    return HttpResponse(content=content, content_type="text/plain")
 
 
 def redirect_to_login(request):
@@ -19,6 +59,57 @@ def redirect_to_login(request):
     If it does not exists it redirects to root.
     """
 
-    login_url = WebsiteSettings.get_login_url(request.site)
+    login_url = get_login_url(request.site)
     return HttpResponseRedirect(login_url or '/')
 
+
+def compiled_css(request, file_name):
+    """
+    Serves compiled css file written by Css.save().
+    File name contains hash of the content, so it is cached "forever".
+    Precompressed .gz version is served to clients accepting gzip.
+    """
+    if not CSS_FILE_NAME_RE.match(file_name):
+        raise Http404()
+
+    path = get_css_path(file_name)
+    gzipped = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '') and default_storage.exists(path + '.gz')
+    if gzipped:
+        path += '.gz'
+    elif not default_storage.exists(path):
+        raise Http404()
+
+    with default_storage.open(path) as css_file:
+        response = HttpResponse(content=css_file.read(), content_type="text/css; charset=utf-8")
+
+    if gzipped:
+        response['Content-Encoding'] = 'gzip'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+def sitemap_index(request):
+    """
+    Sitemap index listing sections of the sitemap (see wagboot.sitemap).
+    """
+    return HttpResponse(content=get_sitemap_index(request.site), content_type="application/xml")
+
+
+def sitemap_section(request, section):
+    """
+    Section of the sitemap, it is cached gzipped and served as is to clients accepting gzip.
+    """
+    content = get_sitemap_section(request.site, int(section))
+    if content is None:
+        raise Http404()
+
+    gzipped = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if not gzipped:
+        with gzip.GzipFile(fileobj=io.BytesIO(content), mode='rb') as xml:
+            content = xml.read()
+    response = HttpResponse(content=content, content_type="application/xml")
+    if gzipped:
+        response['Content-Encoding'] = 'gzip'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response